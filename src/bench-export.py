@@ -0,0 +1,179 @@
+import argparse
+import datetime
+import inspect
+import itertools
+import os
+import pathlib
+import platform
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from module.export import ExportItem, FromId, PeerId, get_items
+from module.mock_server import MockServer, get_mock_arguments
+from module.synthetic import write_synthetic_export
+from module.utils import json_dump, json_load, mmap_readline, reverse_readline, yaml_dump
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("--input", "-i")
+argparser.add_argument("--mode", "-m", choices=["decode", "read", "micro", "load"], default="decode")
+argparser.add_argument("--count", "-n", type=int, default=2_000_000)
+argparser.add_argument("--users", type=int, default=1000)
+argparser.add_argument("--message-length", type=int, default=12)
+argparser.add_argument("--output", "-o")
+# load test: the mock server's answer time and share of 429 responses, the pipeline's parallel requests
+argparser.add_argument("--latency", type=float, default=0.5)
+argparser.add_argument("--jitter", type=float, default=0.1)
+argparser.add_argument("--rate-limit", type=float, default=0.0)
+argparser.add_argument("--concurrency", "-c", type=int, default=8)
+argparser.add_argument("--workers", "-w", type=int, default=os.cpu_count())
+# the legacy decoder runs at a few hundred messages per second, so only a prefix is timed
+argparser.add_argument("--legacy-limit", type=int, default=50_000)
+args = argparser.parse_args()
+
+root_dir = pathlib.Path(__file__).parents[1]
+results = []
+
+
+def legacy_from_dict(cls, env: dict[str, any], field_map: dict[str, str]):
+    # FromDict.from_dict() before the field names were precomputed
+    out = {}
+    for k, v in env.items():
+        k = field_map.get(k, k)
+        if k in inspect.signature(cls).parameters:
+            out[k] = v
+    return cls(**out)
+
+
+def legacy_get_items(data_path: pathlib.Path):
+    for line in reverse_readline(data_path):
+        data = json_load(line)
+
+        if "message" not in data:
+            continue
+
+        data["date"] = datetime.datetime.fromisoformat(data["date"])
+        data["peer_id"] = legacy_from_dict(PeerId, data.get("peer_id"), PeerId.field_map)
+        data["from_id"] = legacy_from_dict(FromId, data.get("from_id"), FromId.field_map)
+
+        yield legacy_from_dict(ExportItem, data, ExportItem.field_map)
+
+
+def add_result(name: str, count: int, elapsed: float, unit: str = "messages", **extra):
+    print(f"{name}: {count} {unit} in {elapsed:.2f}s, {count / elapsed:,.0f} {unit}/s")
+    results.append(dict(name=name, count=count, unit=unit, seconds=round(elapsed, 4), rate=count / elapsed, **extra))
+
+
+def measure(name: str, items, unit: str = "messages"):
+    start = time.perf_counter()
+    count = sum(1 for _ in items)
+    add_result(name, count, time.perf_counter() - start, unit)
+
+
+def load_process_export(data_path: pathlib.Path):
+    """Globals of process-export.py, which parses its arguments on import"""
+    argv = sys.argv
+    sys.argv = ["process-export.py", "-i", data_path.as_posix(), "--no-cache", "--no-results", "--no-log"]
+    try:
+        return runpy.run_path((root_dir / "src/process-export.py").as_posix(), run_name="bench")
+    finally:
+        sys.argv = argv
+
+
+def bench_decode(data_path: pathlib.Path):
+    measure("legacy", itertools.islice(legacy_get_items(data_path), args.legacy_limit))
+    measure("get_items", get_items(data_path))
+    measure(f"get_items workers={args.workers}", get_items(data_path, workers=args.workers))
+
+
+def bench_read(data_path: pathlib.Path):
+    measure("reverse_readline", reverse_readline(data_path))
+    measure("mmap_readline", mmap_readline(data_path, reverse=True))
+    measure("mmap_readline decoded", (str(line, "utf-8") for line in mmap_readline(data_path, reverse=True)))
+    measure("get_items buffered", get_items(data_path, reader="buffered"))
+    measure("get_items mmap", get_items(data_path, reader="mmap"))
+
+
+def bench_micro(data_path: pathlib.Path):
+    measure("get_items", get_items(data_path))
+
+    lines = [json_load(line) for line in itertools.islice(reverse_readline(data_path), 100_000)]
+    measure("FromDict.from_dict", (ExportItem.from_dict(data) for data in lines))
+
+    process_export = load_process_export(data_path)
+    chunks = list(process_export["get_messages_chunk"](data_path))
+    start = time.perf_counter()
+    count = sum(len(chunk.items) for chunk in process_export["get_messages_chunk"](data_path))
+    add_result("get_messages_chunk", count, time.perf_counter() - start)
+
+    response = get_mock_arguments(dict(messages=[dict(content="buy now http://spam.example\nhello")]))
+    measure("yaml_dump", (yaml_dump([response]) for _ in range(2_000)), unit="responses")
+    measure("yaml_dump chunk", (yaml_dump([chunk.messages]) for chunk in chunks[:200]), unit="chunks")
+
+
+def bench_load(data_path: pathlib.Path):
+    """process-export.py end to end against the mock server"""
+    server = MockServer(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = dict(os.environ, OPENAI_BASE_URL=server.base_url, OPENAI_API_KEY="mock")
+    command = [sys.executable, (root_dir / "src/process-export.py").as_posix(), "-i", data_path.as_posix()]
+    command += ["-a", "bench", "-c", str(args.concurrency), "--no-cache", "--no-results", "--no-log"]
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    stats = server.state.stats()
+    count = sum(1 for _ in get_items(data_path))
+    rate_limited = stats["rate_limited"] / max(stats["requests"], 1)
+    add_result(
+        "process-export",
+        count,
+        elapsed,
+        latency=args.latency,
+        concurrency=args.concurrency,
+        requests=stats["requests"],
+        rate_limited=round(rate_limited, 4),
+        requests_per_second=stats["requests"] / elapsed,
+    )
+    print(f"requests: {stats['requests']}, 429: {stats['rate_limited']} ({rate_limited:.1%})")
+
+
+def get_version() -> str | None:
+    out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir, capture_output=True, text=True)
+    return out.stdout.strip() or None
+
+
+def save_results(path: pathlib.Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = dict(
+        version=get_version(),
+        date=datetime.datetime.now().isoformat(),
+        mode=args.mode,
+        count=args.count,
+        python=platform.python_version(),
+        results=results,
+    )
+    path.write_text(json_dump(data, 2))
+    print(f"saved_to: {path}")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = pathlib.Path(args.input) if args.input else pathlib.Path(tmp_dir) / "export.jsonl"
+        if not args.input:
+            print(f"generating {args.count} messages")
+            write_synthetic_export(data_path, args.count, users=args.users, message_length=args.message_length)
+
+        modes = dict(decode=bench_decode, read=bench_read, micro=bench_micro, load=bench_load)
+        modes[args.mode](data_path)
+
+    now = datetime.datetime.now()
+    save_results(pathlib.Path(args.output or root_dir / f"tmp/bench/{args.mode}-{now:%Y-%m-%d-%H-%M-%S}.json"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import argparse
+import pathlib
+import time
+
+from module.columnar import write_columnar
+from module.export import get_items
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("--input", "-i")
+argparser.add_argument("--output", "-o")
+args = argparser.parse_args()
+
+
+def convert():
+    data_path = pathlib.Path(args.input)
+    out_path = pathlib.Path(args.output) if args.output else data_path.with_name(f"{data_path.name}.columns")
+    start = time.perf_counter()
+    count = write_columnar(out_path, get_items(data_path))
+    print(f"converted {count} messages in {time.perf_counter() - start:.1f}s")
+    print("saved_to: ", out_path)
+
+
+def main():
+    convert()
+
+
+if __name__ == "__main__":
+    main()
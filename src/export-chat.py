@@ -1,12 +1,15 @@
 import argparse
+import asyncio
 import datetime
+import os
 import pathlib
+import shutil
 from signal import SIG_DFL, SIGINT, SIGPIPE, signal
 
 import telethon
-from asyncstdlib import enumerate
 
-from module.utils import get_pass, json_dump
+from module.compression import BLOCK_SIZE, gzip_readline, is_gzip, open_export
+from module.utils import get_pass, json_dump, json_load
 
 signal(SIGPIPE, SIG_DFL)
 
@@ -22,6 +25,8 @@ root_dir = pathlib.Path(__file__).parents[1]
 argparser = argparse.ArgumentParser()
 argparser.add_argument("--output", "-o")
 argparser.add_argument("--name", "-n")
+argparser.add_argument("--incremental", action="store_true")
+argparser.add_argument("--parallel", "-p", type=int, default=1)
 args = argparser.parse_args()
 
 
@@ -33,16 +38,101 @@ api_hash = get_pass("TG_API_HASH")
 client = telethon.TelegramClient(session_file, api_id, api_hash)
 
 
+def get_last_id(data_path: pathlib.Path):
+    # iter_messages goes newest first, so the first line holds the highest id
+    lines = gzip_readline(data_path) if is_gzip(data_path) else data_path.open("rb")
+    for line in lines:
+        return json_load(line)["id"]
+    return None
+
+
+def get_ranges(min_id: int, max_id: int, count: int) -> list[tuple[int, int]]:
+    """Splits the ids (min_id, max_id] into count ranges, newest first"""
+    step = max(1, -(-(max_id - min_id) // count))
+    bounds = list(range(max_id, min_id, -step)) + [min_id]
+    return list(zip(bounds[1:], bounds[:-1]))
+
+
+def get_range_path(out_file_path: pathlib.Path, low: int, high: int) -> pathlib.Path:
+    return out_file_path.with_name(f"{out_file_path.name}.part-{low}-{high}")
+
+
+async def flood_wait(name: str, e: telethon.errors.FloodWaitError):
+    # longer than the client's flood_sleep_threshold, wait it out
+    print(f"{name}: flood wait {e.seconds}s")
+    await asyncio.sleep(e.seconds)
+
+
+async def get_last_message(name: str):
+    while True:
+        try:
+            return await client.get_messages(name, limit=1)
+        except telethon.errors.FloodWaitError as e:
+            await flood_wait("last message", e)
+
+
+async def download_messages(out_file, label: str, low: int, high: int | None = None, progress: int = 1000):
+    """Writes the messages with ids in (low, high] newest first, after a flood wait it goes on below the last id"""
+    max_id = high + 1 if high is not None else 0
+    count = 0
+    while True:
+        try:
+            async for item in client.iter_messages(args.name, min_id=low, max_id=max_id):
+                out_file.write("{}\n".format(json_dump(item.to_dict())))
+                max_id = item.id
+                count += 1
+                if count % progress == 0:
+                    print(f"{label}: {count}")
+            break
+        except telethon.errors.FloodWaitError as e:
+            await flood_wait(label, e)
+    print(f"{label}: {count} messages")
+
+
+async def download_range(low: int, high: int, path: pathlib.Path):
+    with path.open("w", buffering=BLOCK_SIZE) as out_file:
+        await download_messages(out_file, f"range {low}-{high}", low, high)
+
+
+async def download_parallel(out_file, min_id: int):
+    last = await get_last_message(args.name)
+    if not last or last[0].id <= min_id:
+        return
+    ranges = get_ranges(min_id, last[0].id, args.parallel)
+    paths = [get_range_path(pathlib.Path(args.output), low, high) for low, high in ranges]
+    await asyncio.gather(*(download_range(low, high, path) for (low, high), path in zip(ranges, paths)))
+
+    # the ranges are newest first and so is each range, concatenated they are one newest first export
+    for path in paths:
+        with path.open() as in_file:
+            shutil.copyfileobj(in_file, out_file, BLOCK_SIZE)
+    for path in paths:
+        path.unlink()
+
+
 async def export():
     now = datetime.datetime.now()
     print(f"⏰ {now}")
     out_file_path = pathlib.Path(args.output)
-    out_file = out_file_path.open("w")
 
-    async for index, item in enumerate(client.iter_messages(args.name)):
-        if index % 100 == 0:
-            print(index)
-        out_file.write("{}\n".format(json_dump(item.to_dict())))
+    min_id = None
+    if args.incremental and out_file_path.exists():
+        min_id = get_last_id(out_file_path)
+        print(f"min_id: {min_id}")
+
+    # new messages have to go in front of the existing ones to keep the file newest first
+    new_file_path = out_file_path if min_id is None else out_file_path.with_name(f"{out_file_path.name}.new")
+    with open_export(new_file_path, compress=out_file_path.suffix == ".gz") as out_file:
+        if args.parallel > 1:
+            await download_parallel(out_file, min_id or 0)
+        else:
+            await download_messages(out_file, "export", min_id or 0, progress=100)
+
+    if min_id is not None:
+        # appended as is, gzip members and plain lines both concatenate
+        with out_file_path.open("rb") as in_file, new_file_path.open("ab") as out_file:
+            shutil.copyfileobj(in_file, out_file, BLOCK_SIZE)
+        os.replace(new_file_path, out_file_path)
 
 
 async def main():
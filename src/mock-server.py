@@ -0,0 +1,38 @@
+import argparse
+
+from module.mock_server import MockServer
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("--host", default="127.0.0.1")
+argparser.add_argument("--port", "-p", type=int, default=8000)
+argparser.add_argument("--batch-delay", type=float, default=1.0)
+argparser.add_argument("--latency", type=float, default=0.0)
+argparser.add_argument("--jitter", type=float, default=0.0)
+argparser.add_argument("--rate-limit", type=float, default=0.0)
+argparser.add_argument("--stall", type=float, default=0.0)
+argparser.add_argument("--stall-time", type=float, default=60.0)
+args = argparser.parse_args()
+
+
+def main():
+    server = MockServer(
+        args.host,
+        args.port,
+        batch_delay=args.batch_delay,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        stall=args.stall,
+        stall_time=args.stall_time,
+    )
+    print(f"OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
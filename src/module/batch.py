@@ -0,0 +1,62 @@
+import pathlib
+import time
+
+import openai
+
+from module.utils import json_dump, json_load
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# batch statuses that won't change anymore
+FINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+def get_batch_request(custom_id: str, body: dict) -> dict:
+    return dict(custom_id=custom_id, method="POST", url=BATCH_ENDPOINT, body=body)
+
+
+def write_batch_file(path: pathlib.Path, requests: list[dict]):
+    with path.open("w") as fh:
+        for request in requests:
+            fh.write(f"{json_dump(request)}\n")
+
+
+def submit_batch(client: openai.OpenAI, path: pathlib.Path, completion_window: str = "24h") -> str:
+    with path.open("rb") as fh:
+        batch_file = client.files.create(file=fh, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT, completion_window=completion_window
+    )
+    return batch.id
+
+
+def wait_batch(client: openai.OpenAI, batch_id: str, poll_interval: float, timeout: float | None = None):
+    start = time.monotonic()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            return batch
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"batch {batch_id} is still {batch.status} after {timeout}s")
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"batch {batch_id}: {batch.status}, {counts.completed + counts.failed}/{counts.total} requests")
+        time.sleep(poll_interval)
+
+
+def read_batch_file(client: openai.OpenAI, file_id: str | None) -> list[dict]:
+    if file_id is None:
+        return []
+    return [json_load(line) for line in client.files.content(file_id).text.splitlines() if line.strip()]
+
+
+def get_batch_results(client: openai.OpenAI, batch) -> dict[str, dict]:
+    """custom_id -> chat completion body, or {"error": ...} for the requests that failed"""
+    out = {}
+    for line in read_batch_file(client, batch.output_file_id) + read_batch_file(client, batch.error_file_id):
+        response = line.get("response") or {}
+        if line.get("error") is None and response.get("status_code") == 200:
+            out[line["custom_id"]] = response["body"]
+        else:
+            out[line["custom_id"]] = dict(error=line.get("error") or response.get("body"))
+    return out
@@ -0,0 +1,89 @@
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+
+from module.utils import json_dump, json_load
+
+
+class ResponseCache(object):
+    """Content-addressed SQLite store for LLM responses with age and size based eviction"""
+
+    def __init__(self, path: pathlib.Path, max_size: int | None = None, max_age: float | None = None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    @staticmethod
+    def get_key(*parts: any) -> str:
+        return hashlib.sha256(json_dump(parts).encode()).hexdigest()
+
+    def _is_expired(self, created: float, now: float):
+        return self.max_age is not None and now - created > self.max_age
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or self._is_expired(row[1], now):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json_load(row[0])
+
+    def set(self, key: str, value: any):
+        data = json_dump(value)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+
+    def evict(self):
+        with self._lock:
+            if self.max_age is not None:
+                self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_size is not None:
+                # drop least recently used entries beyond the size budget
+                self._db.execute(
+                    """
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM responses
+                        ) WHERE total > ?
+                    )
+                    """,
+                    (self.max_size,),
+                )
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return dict(hits=self.hits, misses=self.misses, entries=count, size=size)
+
+    def close(self):
+        self.evict()
+        self._db.close()
@@ -0,0 +1,36 @@
+import datetime
+import os
+import pathlib
+from dataclasses import dataclass, field
+from typing import Optional
+
+from module.export import FromDict
+from module.utils import json_dump, json_load
+
+
+@dataclass
+class Checkpoint(FromDict):
+    log_file: str
+    chunks: int = 0
+    last_id: Optional[int] = None
+    last_date: Optional[datetime.datetime] = None
+    # a submitted --batch job, waited for again on --resume
+    batch_id: Optional[str] = None
+    # [first_id, last_id] of the chunks that ran out of retries, analyzed again on --resume
+    failed: list[list[int]] = field(default_factory=list)
+
+
+def load_checkpoint(path: pathlib.Path) -> Checkpoint | None:
+    if not path.exists():
+        return None
+    data = json_load(path.read_text())
+    if data.get("last_date") is not None:
+        data["last_date"] = datetime.datetime.fromisoformat(data["last_date"])
+    return Checkpoint.from_dict(data)
+
+
+def save_checkpoint(path: pathlib.Path, checkpoint: Checkpoint):
+    # write-then-rename, so a crash never leaves a half written checkpoint behind
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json_dump(checkpoint, 2))
+    os.replace(tmp_path, path)
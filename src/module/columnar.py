@@ -0,0 +1,134 @@
+import array
+import datetime
+import mmap
+import pathlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from module.utils import json_dump, json_load
+
+FORMAT_VERSION = 1
+
+PEER_TYPES = ["", "PeerUser", "PeerChannel", "PeerChat"]
+
+COLUMNS_DTYPE = np.dtype(
+    [
+        ("id", "<i8"),
+        ("date", "<i8"),
+        ("user", "<i8"),
+        ("from_type", "u1"),
+        ("peer_channel", "<i8"),
+        ("text_offset", "<i8"),
+        ("text_length", "<i4"),
+    ]
+)
+
+
+@dataclass
+class ColumnarRow:
+    id: int
+    date: datetime.datetime
+    from_type: str | None
+    user: int | None
+    peer_channel: int | None
+    message: str
+
+
+class ColumnarExport(object):
+    """Memory-mapped columns of an export converted by write_columnar()"""
+
+    def __init__(self, path: pathlib.Path):
+        meta = json_load((path / "meta.json").read_text())
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"unsupported columnar export version: {meta['version']}")
+        self.path = path
+        self.columns = np.load(path / "columns.npy", mmap_mode="r")
+        self._text_file = (path / "text.bin").open("rb")
+        # mmap can't map an empty file
+        self._text = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ) if meta["text_size"] else b""
+
+    def __len__(self):
+        return len(self.columns)
+
+    def get_text(self, offset: int, length: int) -> str:
+        return self._text[offset : offset + length].decode()
+
+    def get_range(
+        self,
+        min_id: int | None = None,
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+    ) -> tuple[int, int]:
+        """Positions of the messages matching the filters, both columns are ascending"""
+        start = 0
+        stop = len(self.columns)
+        if min_id is not None:
+            start = max(start, int(np.searchsorted(self.columns["id"], min_id, side="right")))
+        if since is not None:
+            start = max(start, int(np.searchsorted(self.columns["date"], int(since.timestamp()), side="left")))
+        if until is not None:
+            stop = min(stop, int(np.searchsorted(self.columns["date"], int(until.timestamp()), side="right")))
+        return start, max(start, stop)
+
+    def rows(self, start: int = 0, stop: int | None = None, block_size: int = 65536):
+        stop = len(self.columns) if stop is None else min(stop, len(self.columns))
+        for block_start in range(start, stop, block_size):
+            # numpy scalars are slow to touch one by one, convert a whole block to python values at once
+            block = self.columns[block_start : min(stop, block_start + block_size)]
+            values = zip(*(block[name].tolist() for name in COLUMNS_DTYPE.names))
+            for message_id, date, user, from_type, peer_channel, text_offset, text_length in values:
+                yield ColumnarRow(
+                    id=message_id,
+                    date=datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+                    from_type=PEER_TYPES[from_type] or None,
+                    user=user if user >= 0 else None,
+                    peer_channel=peer_channel if peer_channel >= 0 else None,
+                    message=self.get_text(text_offset, text_length),
+                )
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._text_file.close()
+
+
+def get_peer_type_code(peer_type: str | None) -> int:
+    return PEER_TYPES.index(peer_type) if peer_type in PEER_TYPES else 0
+
+
+def write_columnar(path: pathlib.Path, items):
+    """Writes items (oldest first, as get_items() yields them) into a columns directory"""
+    path.mkdir(parents=True, exist_ok=True)
+    columns = {name: array.array("q") for name in ["id", "date", "user", "peer_channel", "text_offset"]}
+    from_types = array.array("B")
+    text_lengths = array.array("i")
+
+    offset = 0
+    with (path / "text.bin").open("wb") as text_file:
+        for item in items:
+            text = (item.message or "").encode()
+            text_file.write(text)
+
+            from_id = item.from_id
+            user = -1
+            if from_id is not None:
+                user = from_id.user_id if from_id.user_id is not None else from_id.channel_id
+            columns["id"].append(item.id)
+            columns["date"].append(int(item.date.timestamp()))
+            columns["user"].append(int(user) if user is not None else -1)
+            columns["peer_channel"].append(item.peer_id.channel_id if item.peer_id is not None else -1)
+            columns["text_offset"].append(offset)
+            from_types.append(get_peer_type_code(from_id.from_type if from_id is not None else None))
+            text_lengths.append(len(text))
+            offset += len(text)
+
+    out = np.zeros(len(from_types), dtype=COLUMNS_DTYPE)
+    for name, values in columns.items():
+        out[name] = np.frombuffer(values, dtype="<i8")
+    out["from_type"] = np.frombuffer(from_types, dtype="u1")
+    out["text_length"] = np.frombuffer(text_lengths, dtype="<i4")
+    np.save(path / "columns.npy", out)
+
+    (path / "meta.json").write_text(json_dump(dict(version=FORMAT_VERSION, count=len(out), text_size=offset), 2))
+    return len(out)
@@ -0,0 +1,116 @@
+import gzip
+import pathlib
+import struct
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# uncompressed bytes per gzip member, each member holds whole lines
+BLOCK_SIZE = 1024 * 1024
+
+# gzip header with FEXTRA set and an "SV" subfield holding the size of the whole member, like the BC subfield of BGZF
+HEADER = struct.Struct("<2sBBIBBHccHI")
+FOOTER = struct.Struct("<II")
+FEXTRA = 4
+SUBFIELD = (b"S", b"V")
+
+
+def is_gzip(path: pathlib.Path) -> bool:
+    with open(path, "rb") as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+def compress_block(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = HEADER.size + len(body) + FOOTER.size
+    header = HEADER.pack(GZIP_MAGIC, 8, FEXTRA, 0, 0, 255, 8, *SUBFIELD, 4, size)
+    return header + body + FOOTER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+
+class BlockGzipWriter(object):
+    """Text writer that compresses every block of whole lines into its own gzip member
+
+    The members concatenate into a regular .gz file, and their sizes in the headers let get_blocks() find every
+    block without decompressing, so the file can be read backwards.
+    """
+
+    def __init__(self, path: pathlib.Path, block_size: int = BLOCK_SIZE, level: int = 6, mode: str = "wb"):
+        self.fh = open(path, mode)
+        self.block_size = block_size
+        self.level = level
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text: str):
+        data = text.encode()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self, final: bool = False):
+        data = b"".join(self.buffer)
+        # a block ends on a line boundary, the rest waits for the next one
+        cut = len(data) if final else data.rfind(b"\n") + 1
+        if cut:
+            self.fh.write(compress_block(data[:cut], self.level))
+        self.buffer = [data[cut:]] if cut < len(data) else []
+        self.size = len(data) - cut
+
+    def close(self):
+        if self.fh.closed:
+            return
+        if self.size:
+            self.flush_block(final=True)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_export(path: pathlib.Path, compress: bool = False):
+    """Block buffered text writer for an export"""
+    if compress:
+        return BlockGzipWriter(path)
+    return path.open("w", buffering=BLOCK_SIZE)
+
+
+def get_blocks(path: pathlib.Path) -> list[tuple[int, int]] | None:
+    """Offsets and sizes of the members written by BlockGzipWriter, None for any other gzip file"""
+    blocks = []
+    with open(path, "rb") as fh:
+        offset = 0
+        while header := fh.read(HEADER.size):
+            if len(header) < HEADER.size:
+                return None
+            magic, method, flags, _, _, _, xlen, si1, si2, slen, size = HEADER.unpack(header)
+            if magic != GZIP_MAGIC or not flags & FEXTRA or (si1, si2) != SUBFIELD or xlen != 8 or slen != 4:
+                return None
+            blocks.append((offset, size))
+            offset += size
+            fh.seek(offset)
+    return blocks
+
+
+def gzip_readline(path: pathlib.Path, reverse: bool = False):
+    """A generator that returns the lines of a gzip file as bytes, backwards a block at a time when reverse is set"""
+    blocks = get_blocks(path)
+    if blocks is None:
+        # a plain gzip stream has no block sizes, it can only be decompressed from the start
+        with gzip.open(path, "rb") as fh:
+            lines = (line.rstrip(b"\n") for line in fh)
+            yield from reversed(list(lines)) if reverse else lines
+        return
+
+    with open(path, "rb") as fh:
+        for offset, size in reversed(blocks) if reverse else blocks:
+            fh.seek(offset)
+            lines = gzip.decompress(fh.read(size)).split(b"\n")
+            # every block ends with a newline
+            if lines and not lines[-1]:
+                lines.pop()
+            yield from reversed(lines) if reverse else lines
@@ -0,0 +1,96 @@
+import re
+import zlib
+from dataclasses import dataclass, field
+
+import numpy as np
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+normalize_regex = re.compile(r"\W+")
+digits_regex = re.compile(r"\d+")
+
+
+def normalize(text: str) -> str:
+    # spam variations usually differ in punctuation, case and numbers (prices, phones, promo codes)
+    return normalize_regex.sub(" ", digits_regex.sub("0", text.lower())).strip()
+
+
+def get_shingles(text: str, size: int) -> set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[index : index + size] for index in range(len(text) - size + 1)}
+
+
+@dataclass
+class DuplicateGroup:
+    id: int
+    count: int = 1
+    users: set[str] = field(default_factory=set)
+
+
+class DuplicateIndex(object):
+    """Streaming MinHash + LSH index that groups near-identical messages"""
+
+    def __init__(
+        self,
+        num_perm: int = 64,
+        bands: int = 8,
+        threshold: float = 0.8,
+        shingle_size: int = 4,
+        min_length: int = 30,
+        seed: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_length = min_length
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self._buckets: dict[bytes, int] = {}
+        self._signatures: list[np.ndarray] = []
+        self.groups: list[DuplicateGroup] = []
+        self.messages = 0
+        self.duplicates = 0
+
+    def get_signature(self, text: str) -> np.ndarray:
+        shingles = get_shingles(text, self.shingle_size)
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), np.uint64, len(shingles))
+        return ((self._a * hashes + self._b) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def get_band_keys(self, signature: np.ndarray) -> list[bytes]:
+        return [
+            bytes([band]) + signature[band * self.rows : (band + 1) * self.rows].tobytes() for band in range(self.bands)
+        ]
+
+    def add(self, text: str, user: str) -> DuplicateGroup | None:
+        """Returns the group of the message, None when it is too short to be tracked"""
+        text = normalize(text)
+        if len(text) < self.min_length:
+            return None
+        self.messages += 1
+
+        signature = self.get_signature(text)
+        keys = self.get_band_keys(signature)
+        for key in keys:
+            group_id = self._buckets.get(key)
+            # a shared band only makes it a candidate, check the estimated similarity
+            if group_id is not None and np.mean(self._signatures[group_id] == signature) >= self.threshold:
+                group = self.groups[group_id]
+                group.count += 1
+                group.users.add(user)
+                self.duplicates += 1
+                return group
+
+        group = DuplicateGroup(id=len(self.groups), users={user})
+        self.groups.append(group)
+        self._signatures.append(signature)
+        for key in keys:
+            self._buckets.setdefault(key, group.id)
+        return group
+
+    def stats(self):
+        return dict(messages=self.messages, groups=len(self.groups), duplicates=self.duplicates)
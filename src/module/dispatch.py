@@ -0,0 +1,210 @@
+import collections
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable
+
+import openai
+
+
+class RateLimiter(object):
+    """Requests-per-minute and tokens-per-minute token buckets shared by all workers"""
+
+    def __init__(self, rpm: int | None = None, tpm: int | None = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm or 0)
+        self._tokens = float(tpm or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = max(0.0, self._paused_until - now)
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        if self.tpm and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        # a single request larger than the whole budget would wait forever
+        tokens = min(tokens, self.tpm) if self.tpm else tokens
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def get_retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# worth another attempt, anything else fails the same way again
+RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, TimeoutError)
+
+_deadline = threading.local()
+
+
+def get_time_left() -> float | None:
+    """Seconds until the deadline of the call_with_backoff() running in this thread, None without one"""
+    deadline = getattr(_deadline, "value", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def call_with_backoff(
+    func: Callable,
+    item: any,
+    limiter: RateLimiter | None = None,
+    tokens: int | None = 0,
+    retries: int = 5,
+    backoff: float = 1.0,
+    deadline: float | None = None,
+):
+    """deadline is in seconds for all the attempts together, func reads what is left with get_time_left()"""
+    _deadline.value = None if deadline is None else time.monotonic() + deadline
+    try:
+        for attempt in range(retries + 1):
+            # no cost means the call doesn't reach the API
+            if limiter is not None and tokens is not None:
+                limiter.acquire(tokens)
+            time_left = get_time_left()
+            if time_left is not None and time_left <= 0:
+                raise TimeoutError(f"deadline of {deadline}s exceeded after {attempt} attempts")
+            try:
+                return func(item)
+            except RETRY_ERRORS as e:
+                if attempt >= retries:
+                    raise
+                delay = get_retry_after(e) or backoff * 2**attempt
+                delay *= 1 + random.random() / 2
+                time_left = get_time_left()
+                if time_left is not None and delay >= time_left:
+                    raise
+                if limiter is not None and isinstance(e, openai.RateLimitError):
+                    # everybody hits the same quota, so hold back the other workers too
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+    finally:
+        _deadline.value = None
+
+
+class LatencyWindow(object):
+    """Latencies of the recent calls, a call slower than their percentile is worth hedging"""
+
+    def __init__(self, percentile: float = 95, size: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def get_threshold(self) -> float | None:
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+
+def hedge(
+    primary: Callable,
+    backup: Callable,
+    delay: float | None,
+    executor: ThreadPoolExecutor,
+    on_lost: Callable[[int], None] | None = None,
+) -> tuple[int, any]:
+    """Runs primary, and backup as well once primary took longer than delay, (0 or 1, result) of the first success"""
+    if delay is None:
+        return 0, primary()
+    futures = [executor.submit(primary)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        futures.append(executor.submit(backup))
+    error = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            # the loser can't be cancelled mid request, on_lost hears about it once it is paid for anyway
+            for index, other in enumerate(futures):
+                if other is not future and on_lost is not None:
+                    other.add_done_callback(
+                        lambda f, index=index: not f.cancelled() and f.exception() is None and on_lost(index)
+                    )
+            return futures.index(future), result
+    raise error
+
+
+def dispatch(
+    func: Callable,
+    items: Iterable,
+    concurrency: int = 1,
+    limiter: RateLimiter | None = None,
+    cost: Callable[[any], int | None] | None = None,
+    retries: int = 5,
+    backoff: float = 1.0,
+    deadline: float | None = None,
+):
+    """Runs func over items in a thread pool and yields (item, result, error) in the input order"""
+
+    def run(item):
+        tokens = cost(item) if cost is not None else 0
+        return call_with_backoff(func, item, limiter, tokens, retries, backoff, deadline)
+
+    def pop(pending: collections.deque):
+        item, future = pending.popleft()
+        try:
+            return item, future.result(), None
+        except Exception as e:
+            return item, None, e
+
+    concurrency = max(1, concurrency)
+    executor = ThreadPoolExecutor(concurrency)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(run, item)))
+            # keep a bounded window so a huge export is not read into memory at once
+            while len(pending) >= concurrency * 2:
+                yield pop(pending)
+        while pending:
+            yield pop(pending)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,112 @@
+import datetime
+
+from module.utils import indent, json_dump
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# response fields holding user ids
+USER_FIELDS = ["suspicious_users", "potential_bots"]
+
+
+def escape(text: str) -> str:
+    return text.replace("\t", " ").replace("\r", "").replace("\n", "\\n")
+
+
+class PromptEncoder(object):
+    """Serializes a chunk of messages (userID, text, date) into the prompt"""
+
+    name = ""
+
+    def encode(self, messages: list) -> tuple[str, dict[str, str]]:
+        """Returns the prompt and the alias -> user id map used in it"""
+        raise NotImplementedError()
+
+    def encode_message(self, message) -> str:
+        """The message as it appears in the prompt, used to measure its size before the chunk is closed"""
+        raise NotImplementedError()
+
+    def decode_response(self, response: dict | None, aliases: dict[str, str]) -> dict | None:
+        """Maps the aliases in the user fields back to user ids"""
+        if response is None or not aliases:
+            return response
+        # the other fields quote the messages, where "u1" may be a word of the chat and not an alias
+        out = dict(response)
+        for key in USER_FIELDS:
+            if isinstance(out.get(key), list):
+                out[key] = [str(aliases[user]) if user in aliases else user for user in out[key]]
+        return out
+
+
+class JsonEncoder(PromptEncoder):
+    name = "json"
+
+    def encode(self, messages: list) -> tuple[str, dict[str, str]]:
+        return f"Messages:\n{indent(json_dump(messages, 2))}", {}
+
+    def encode_message(self, message) -> str:
+        return indent(json_dump(message, 2), 4)
+
+
+class TsvEncoder(PromptEncoder):
+    """One line per message with short user aliases, duplicates get their counters appended to the text"""
+
+    name = "tsv"
+
+    def get_header(self, start: str) -> str:
+        return "Messages, one per line: user<TAB>time<TAB>text. Users are aliased as u1, u2, ...\n"
+
+    def get_time(self, date: str, start: datetime.datetime) -> str:
+        return date
+
+    def get_text(self, message, get_alias) -> str:
+        text = escape(message.text)
+        count = getattr(message, "count", None)
+        if count is not None:
+            users = ",".join(get_alias(user) for user in message.users)
+            text = f"{text} [x{count} by {users}; {message.total} in export]"
+        return text
+
+    def encode(self, messages: list) -> tuple[str, dict[str, str]]:
+        users = {}
+
+        def get_alias(user: str) -> str:
+            if user not in users:
+                users[user] = f"u{len(users) + 1}"
+            return users[user]
+
+        start = datetime.datetime.strptime(messages[0].date, DATE_FORMAT) if messages else None
+        lines = [self.get_header(messages[0].date if messages else "")]
+        for message in messages:
+            alias = get_alias(message.userID)
+            lines.append(f"{alias}\t{self.get_time(message.date, start)}\t{self.get_text(message, get_alias)}\n")
+        return "".join(lines), {alias: user for user, alias in users.items()}
+
+    def encode_message(self, message) -> str:
+        # aliases and relative times are only known for the whole chunk, two digits is the common case
+        return f"u00\t{self.get_time(message.date, None)}\t{self.get_text(message, lambda user: 'u00')}"
+
+
+class RelativeTsvEncoder(TsvEncoder):
+    """TSV with times as seconds since the first message of the chunk"""
+
+    name = "tsv-relative"
+
+    def get_header(self, start: str) -> str:
+        return (
+            f"Messages from {start}, one per line: user<TAB>seconds since start<TAB>text. "
+            "Users are aliased as u1, u2, ...\n"
+        )
+
+    def get_time(self, date: str, start: datetime.datetime | None) -> str:
+        if start is None:
+            return "+000"
+        return f"+{int((datetime.datetime.strptime(date, DATE_FORMAT) - start).total_seconds())}"
+
+
+ENCODERS = {encoder.name: encoder for encoder in [JsonEncoder, TsvEncoder, RelativeTsvEncoder]}
+
+
+def get_encoder(name: str) -> PromptEncoder:
+    if name not in ENCODERS:
+        raise ValueError(f"unknown prompt encoding: {name}, expected one of {', '.join(ENCODERS)}")
+    return ENCODERS[name]()
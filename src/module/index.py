@@ -0,0 +1,133 @@
+import datetime
+import os
+import pathlib
+import re
+
+import numpy as np
+
+from module.utils import json_load
+
+INDEX_VERSION = 1
+
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("date", "<i8"), ("offset", "<i8")])
+
+# telethon's to_dict() puts the message id and date before any nested object that could carry its own
+id_regex = re.compile(rb'"id": (\d+)')
+date_regex = re.compile(rb'"date": "([^"]+)"')
+
+
+def get_index_path(data_path: pathlib.Path) -> pathlib.Path:
+    return data_path.with_name(f"{data_path.name}.index.npz")
+
+
+def parse_line(line: bytes) -> tuple[int, int] | None:
+    id_match = id_regex.search(line)
+    date_match = date_regex.search(line)
+    if id_match is not None and date_match is not None:
+        date = datetime.datetime.fromisoformat(date_match.group(1).decode())
+        return int(id_match.group(1)), int(date.timestamp())
+    if not line.strip():
+        return None
+    data = json_load(line)
+    if "id" not in data or "date" not in data:
+        return None
+    return data["id"], int(datetime.datetime.fromisoformat(data["date"]).timestamp())
+
+
+def build_entries(data_path: pathlib.Path, start: int = 0, end: int | None = None) -> np.ndarray:
+    ids = []
+    dates = []
+    offsets = []
+    with data_path.open("rb") as fh:
+        fh.seek(start)
+        offset = start
+        for line in fh:
+            if end is not None and offset >= end:
+                break
+            parsed = parse_line(line)
+            if parsed is not None:
+                ids.append(parsed[0])
+                dates.append(parsed[1])
+                offsets.append(offset)
+            offset += len(line)
+
+    entries = np.zeros(len(ids), dtype=INDEX_DTYPE)
+    entries["id"] = ids
+    entries["date"] = dates
+    entries["offset"] = offsets
+    return entries
+
+
+class ExportIndex(object):
+    """Sidecar index of a newest-first JSON strings export: message id and date -> byte offset"""
+
+    def __init__(self, data_path: pathlib.Path, entries: np.ndarray, size: int):
+        self.data_path = data_path
+        self.entries = entries
+        self.size = size
+
+    def save(self):
+        np.savez(get_index_path(self.data_path), entries=self.entries, meta=np.array([INDEX_VERSION, self.size]))
+
+    def _get_offset(self, position: int) -> int:
+        return int(self.entries["offset"][position]) if position < len(self.entries) else self.size
+
+    def get_range(
+        self,
+        min_id: int | None = None,
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+    ) -> tuple[int, int]:
+        """Byte range of the lines matching the filters, ids and dates go down as the offset grows"""
+        # searchsorted wants ascending keys, so search the negated columns
+        ids = -self.entries["id"]
+        dates = -self.entries["date"]
+        start = 0
+        stop = len(self.entries)
+        if until is not None:
+            start = max(start, int(np.searchsorted(dates, -int(until.timestamp()), side="left")))
+        if since is not None:
+            stop = min(stop, int(np.searchsorted(dates, -int(since.timestamp()), side="right")))
+        if min_id is not None:
+            stop = min(stop, int(np.searchsorted(ids, -min_id, side="left")))
+        if start >= stop:
+            return 0, 0
+        return self._get_offset(start), self._get_offset(stop)
+
+
+def is_prepended(data_path: pathlib.Path, index: ExportIndex, delta: int) -> bool:
+    # export-chat.py --incremental writes new messages in front of the old ones
+    if not len(index.entries):
+        return False
+    with data_path.open("rb") as fh:
+        fh.seek(delta)
+        parsed = parse_line(fh.readline())
+    return parsed is not None and parsed[0] == index.entries["id"][0]
+
+
+def load_index(data_path: pathlib.Path) -> ExportIndex:
+    """Loads the sidecar index, building it on first use and extending it when the export grew"""
+    size = os.path.getsize(data_path)
+    index_path = get_index_path(data_path)
+
+    index = None
+    if index_path.exists():
+        with np.load(index_path) as data:
+            version, indexed_size = data["meta"].tolist()
+            if version == INDEX_VERSION:
+                index = ExportIndex(data_path, data["entries"], indexed_size)
+
+    if index is not None and index.size == size:
+        return index
+
+    if index is not None and index.size < size and is_prepended(data_path, index, size - index.size):
+        delta = size - index.size
+        head = build_entries(data_path, 0, delta)
+        tail = index.entries.copy()
+        tail["offset"] += delta
+        index = ExportIndex(data_path, np.concatenate([head, tail]), size)
+    else:
+        index = ExportIndex(data_path, build_entries(data_path), size)
+
+    index.save()
+    return index
@@ -0,0 +1,133 @@
+import functools
+import re
+import threading
+import time
+
+import httpx
+import openai
+from autogen import ConversableAgent
+
+from module.utils import get_pass, json_dump, json_load
+
+json_regex = re.compile(r"\{.*\}", re.DOTALL)
+
+
+@functools.cache
+def get_secret(name: str) -> str:
+    # get_pass() may spawn `pass`, once per process is enough
+    return get_pass(name)
+
+
+# models answered through an autogen agent instead of a raw function call
+AGENT_CONFIGS = {
+    "gemini-pro": lambda: dict(
+        model="gemini-pro",
+        api_type="google",
+        api_key=get_secret("GEMINI_API_KEY"),
+        generation_config=dict(response_mime_type="application/json"),
+    ),
+}
+
+
+def get_function_arguments(function_call, name: str) -> dict | None:
+    if function_call and function_call.name == name:
+        return json_load(function_call.arguments)
+    return None
+
+
+def parse_json_reply(reply: str | dict | None) -> dict | None:
+    if isinstance(reply, dict):
+        reply = reply.get("content")
+    if not reply:
+        return None
+    match = json_regex.search(reply)
+    return json_load(match.group(0)) if match is not None else None
+
+
+class LLMClient(object):
+    """Long-lived clients: secrets resolved once, keep-alive connection pools, one analyze() for every model"""
+
+    def __init__(self, pool_size: int = 8, timeout: float = 120.0):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._openai = None
+        self._agents = threading.local()
+        self._lock = threading.Lock()
+
+    def get_openai(self) -> openai.OpenAI:
+        with self._lock:
+            if self._openai is None:
+                limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+                self._openai = openai.OpenAI(
+                    api_key=get_secret("OPENAI_API_KEY"),
+                    http_client=httpx.Client(limits=limits, timeout=self.timeout),
+                    # retried by call_with_backoff(), which knows the deadline of the chunk
+                    max_retries=0,
+                )
+            return self._openai
+
+    def get_agent(self, model: str) -> ConversableAgent:
+        # an agent keeps per conversation state, so every worker thread gets its own
+        agents = self._agents.__dict__
+        if model not in agents:
+            config = (
+                AGENT_CONFIGS[model]()
+                if model in AGENT_CONFIGS
+                else dict(model=model, api_key=get_secret("OPENAI_API_KEY"))
+            )
+            agents[model] = ConversableAgent(
+                "chatbot",
+                llm_config={"config_list": [config]},
+                # system_message="",
+                function_map=None,
+                code_execution_config=False,
+                human_input_mode="NEVER",
+            )
+        return agents[model]
+
+    def analyze(
+        self,
+        prompt: str,
+        model: str,
+        functions: list[dict],
+        usage: dict | None = None,
+        timeout: float | None = None,
+    ) -> dict | None:
+        """Arguments of the first function in functions as answered by the model, timeout is below the client one"""
+        start = time.perf_counter()
+        if model in AGENT_CONFIGS:
+            arguments, tokens = self.analyze_agent(prompt, model, functions[0])
+        else:
+            arguments, tokens = self.analyze_function_call(prompt, model, functions, timeout)
+        if usage is not None:
+            usage.update(model=model, latency=round(time.perf_counter() - start, 3), **tokens)
+        return arguments
+
+    def analyze_function_call(
+        self, prompt: str, model: str, functions: list[dict], timeout: float | None = None
+    ) -> tuple[dict | None, dict]:
+        response = self.get_openai().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            functions=functions,
+            function_call={"name": functions[0]["name"]},
+            timeout=min(timeout, self.timeout) if timeout is not None else self.timeout,
+        )
+        tokens = dict(prompt_tokens=None, completion_tokens=None)
+        if response.usage is not None:
+            tokens = dict(
+                prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens
+            )
+        return get_function_arguments(response.choices[0].message.function_call, functions[0]["name"]), tokens
+
+    def analyze_agent(self, prompt: str, model: str, function: dict) -> tuple[dict | None, dict]:
+        # agents answer in text, the schema goes into the prompt instead of a function definition
+        content = f"{prompt}\n\nAnswer with a JSON object matching this schema:\n{json_dump(function['parameters'])}"
+        reply = self.get_agent(model).generate_reply(messages=[{"role": "user", "content": content}])
+        return parse_json_reply(reply), dict(prompt_tokens=None, completion_tokens=None)
+
+    def close(self):
+        with self._lock:
+            if self._openai is not None:
+                self._openai.close()
+                self._openai = None
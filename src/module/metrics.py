@@ -0,0 +1,102 @@
+import collections
+import contextlib
+import threading
+import time
+
+import numpy as np
+
+
+class Metrics(object):
+    """Wall time per pipeline stage, API latency and token usage of a run, safe to update from worker threads"""
+
+    def __init__(self, prices: dict[str, dict[str, float]] | None = None):
+        # USD per million tokens by model: {"prompt": ..., "completion": ...}
+        self.prices = prices or {}
+        self.start = time.perf_counter()
+        self.stages = collections.Counter()
+        self.latencies = []
+        self.usage = collections.defaultdict(collections.Counter)
+        self.messages = 0
+        self.chunks = 0
+        # hedged and retried requests and the like
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, items):
+        """Iterates items, counting the time spent producing them"""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def add_usage(self, usage: dict):
+        with self._lock:
+            if "latency" in usage:
+                self.latencies.append(usage["latency"])
+            counter = self.usage[usage.get("model") or "unknown"]
+            counter["calls"] += 1
+            counter["cached"] += int(bool(usage.get("cached")))
+            counter["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            counter["completion_tokens"] += usage.get("completion_tokens") or 0
+
+    def add_count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] += value
+
+    def add_chunk(self, messages: int):
+        with self._lock:
+            self.chunks += 1
+            self.messages += messages
+
+    def get_cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price["prompt"] + completion_tokens * price["completion"]) / 1_000_000
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        with self._lock:
+            usage = {}
+            for model, counter in self.usage.items():
+                usage[model] = dict(counter)
+                usage[model]["cost"] = self.get_cost(model, counter["prompt_tokens"], counter["completion_tokens"])
+            latencies = np.array(self.latencies) if self.latencies else None
+            return dict(
+                seconds=round(elapsed, 3),
+                chunks=self.chunks,
+                messages=self.messages,
+                messages_per_second=round(self.messages / elapsed, 2) if elapsed else None,
+                # api is summed over the workers, it overlaps with the other stages and with itself
+                stages={stage: round(seconds, 3) for stage, seconds in self.stages.most_common()},
+                latency=None
+                if latencies is None
+                else dict(
+                    calls=len(latencies),
+                    mean=round(float(latencies.mean()), 3),
+                    p50=round(float(np.percentile(latencies, 50)), 3),
+                    p95=round(float(np.percentile(latencies, 95)), 3),
+                    max=round(float(latencies.max()), 3),
+                ),
+                usage=usage,
+                counts=dict(self.counts),
+                cost=round(sum(value["cost"] or 0 for value in usage.values()), 4),
+            )
@@ -0,0 +1,293 @@
+import base64
+import email.parser
+import email.policy
+import itertools
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from module.tokens import count_tokens
+from module.utils import json_dump, json_load
+
+link_regex = re.compile(r"(https?://|www\.|t\.me/)", re.IGNORECASE)
+
+
+def get_mock_arguments(body: dict) -> dict:
+    """A canned analyzer answer, suspicious when the prompt has links"""
+    prompt = body["messages"][-1]["content"]
+    suspicious = [line.strip() for line in prompt.splitlines() if link_regex.search(line)]
+    arguments = {
+        "suspicious_activity_detected": bool(suspicious),
+        "suspicious_users": [],
+        "suspicious_messages": suspicious[:5],
+        "potential_bots": [],
+        "advertising_activities": suspicious[:5],
+        "off_topic_messages": [],
+        "manipulative_behaviors": [],
+        "conversation_health": "Suspicious" if suspicious else "Normal",
+        "notes": "Mock response.",
+    }
+    properties = [function["parameters"]["properties"] for function in body.get("functions") or []]
+    if any("confidence" in value for value in properties):
+        arguments["confidence"] = 0.9
+    return arguments
+
+
+def get_mock_stats(url: str) -> dict:
+    """Engine counts of a url, malicious when its host says spam, scam or bad"""
+    host = urllib.parse.urlsplit(url).hostname or ""
+    malicious = 5 if re.search(r"spam|scam|bad", host) else 0
+    return dict(malicious=malicious, suspicious=0, harmless=60 - malicious, undetected=10, timeout=0)
+
+
+def parse_multipart(content_type: str, data: bytes) -> dict[str, tuple[str | None, bytes]]:
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + data
+    )
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+class MockState(object):
+    def __init__(
+        self,
+        batch_delay: float,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit: float = 0.0,
+        stall: float = 0.0,
+        stall_time: float = 60.0,
+    ):
+        self.batch_delay = batch_delay
+        # chat completions sleep latency +- jitter and answer 429 to a rate_limit share of the requests
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        # a stall share of the answers takes stall_time seconds, the tail a deadline or a hedge has to cut
+        self.stall = stall
+        self.stall_time = stall_time
+        self.requests = 0
+        self.rate_limited = 0
+        self.ids = itertools.count(1)
+        self.files: dict[str, dict] = {}
+        self.contents: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        # the VirusTotal side: reports of the analyzed urls by url id, analyses by id
+        self.url_reports: dict[str, dict] = {}
+        self.analyses: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            return dict(requests=self.requests, rate_limited=self.rate_limited)
+
+    def get_latency(self) -> float:
+        if random.random() < self.stall:
+            return self.stall_time
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def is_rate_limited(self) -> bool:
+        limited = random.random() < self.rate_limit
+        with self.lock:
+            self.requests += 1
+            self.rate_limited += limited
+        return limited
+
+    def get_id(self, prefix: str) -> str:
+        return f"{prefix}-mock-{next(self.ids)}"
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        file = dict(
+            id=self.get_id("file"),
+            object="file",
+            bytes=len(content),
+            created_at=int(time.time()),
+            filename=filename,
+            purpose=purpose,
+            status="processed",
+        )
+        with self.lock:
+            self.files[file["id"]] = file
+            self.contents[file["id"]] = content
+        return file
+
+    def get_completion(self, body: dict) -> dict:
+        arguments = get_mock_arguments(body)
+        prompt_tokens = sum(count_tokens(message["content"]) for message in body["messages"])
+        completion_tokens = count_tokens(json_dump(arguments))
+        total_tokens = prompt_tokens + completion_tokens
+        return dict(
+            id=self.get_id("chatcmpl"),
+            object="chat.completion",
+            created=int(time.time()),
+            model=body.get("model", "mock"),
+            choices=[
+                dict(
+                    index=0,
+                    finish_reason="function_call",
+                    message=dict(
+                        role="assistant",
+                        content=None,
+                        function_call=dict(name="analyzer", arguments=json_dump(arguments)),
+                    ),
+                )
+            ],
+            usage=dict(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=total_tokens),
+        )
+
+    def add_batch(self, body: dict) -> dict:
+        batch = dict(
+            id=self.get_id("batch"),
+            object="batch",
+            endpoint=body["endpoint"],
+            input_file_id=body["input_file_id"],
+            completion_window=body["completion_window"],
+            status="in_progress",
+            created_at=int(time.time()),
+            output_file_id=None,
+            error_file_id=None,
+            request_counts=dict(total=0, completed=0, failed=0),
+        )
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        threading.Timer(self.batch_delay, self.run_batch, [batch["id"]]).start()
+        return batch
+
+    def run_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.contents[batch["input_file_id"]].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json_load(line)
+            response = dict(status_code=200, request_id=self.get_id("req"), body=self.get_completion(request["body"]))
+            lines.append(
+                dict(id=self.get_id("batch_req"), custom_id=request["custom_id"], response=response, error=None)
+            )
+        output = self.add_file(
+            "output.jsonl", "batch_output", "".join(f"{json_dump(line)}\n" for line in lines).encode()
+        )
+        with self.lock:
+            batch.update(
+                status="completed",
+                output_file_id=output["id"],
+                request_counts=dict(total=len(lines), completed=len(lines), failed=0),
+            )
+
+    def add_analysis(self, url: str) -> dict:
+        analysis = dict(id=self.get_id("analysis"), type="analysis", attributes=dict(status="queued", stats={}))
+        with self.lock:
+            self.analyses[analysis["id"]] = analysis
+        # the batch delay stands in for the time the engines take
+        threading.Timer(self.batch_delay, self.run_analysis, [analysis["id"], url]).start()
+        return analysis
+
+    def run_analysis(self, analysis_id: str, url: str):
+        stats = get_mock_stats(url)
+        url_id = base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+        with self.lock:
+            self.analyses[analysis_id]["attributes"] = dict(status="completed", stats=stats)
+            self.url_reports[url_id] = dict(id=url_id, type="url", attributes=dict(url=url, last_analysis_stats=stats))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """The part of the OpenAI API used by process-export.py: chat completions, files and batches"""
+
+    server: "MockServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data: dict, status: int = 200, headers: dict[str, str] | None = None):
+        body = json_dump(data).encode()
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_json(
+            dict(error=dict(message=f"{self.command} {self.path} not found", type="invalid_request_error")), 404
+        )
+
+    def send_rate_limited(self):
+        error = dict(message="Rate limit reached (mock)", type="requests", code="rate_limit_exceeded")
+        self.send_json(dict(error=error), 429, {"retry-after": "0.1"})
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        state = self.server.state
+        path = self.path.split("?")[0]
+        if path == "/v1/chat/completions":
+            body = json_load(self.read_body())
+            if state.is_rate_limited():
+                self.send_rate_limited()
+                return
+            time.sleep(state.get_latency())
+            self.send_json(state.get_completion(body))
+        elif path == "/v1/files":
+            fields = parse_multipart(self.headers["Content-Type"], self.read_body())
+            filename, content = fields["file"]
+            self.send_json(state.add_file(filename, fields["purpose"][1].decode(), content))
+        elif path == "/v1/batches":
+            self.send_json(state.add_batch(json_load(self.read_body())))
+        elif path == "/vt/urls":
+            url = urllib.parse.parse_qs(self.read_body().decode())["url"][0]
+            self.send_json(dict(data=state.add_analysis(url)))
+        else:
+            self.send_not_found()
+
+    def do_GET(self):
+        state = self.server.state
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in state.batches:
+            self.send_json(state.batches[parts[2]])
+        elif parts[:2] == ["v1", "files"] and len(parts) >= 3 and parts[2] in state.files:
+            if parts[3:] == ["content"]:
+                content = state.contents[parts[2]]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self.send_json(state.files[parts[2]])
+        elif parts[:2] == ["vt", "urls"] and len(parts) == 3 and parts[2] in state.url_reports:
+            self.send_json(dict(data=state.url_reports[parts[2]]))
+        elif parts[:2] == ["vt", "analyses"] and len(parts) == 3 and parts[2] in state.analyses:
+            self.send_json(dict(data=state.analyses[parts[2]]))
+        else:
+            self.send_not_found()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        batch_delay: float = 1.0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit: float = 0.0,
+        stall: float = 0.0,
+        stall_time: float = 60.0,
+    ):
+        super().__init__((host, port), MockHandler)
+        self.state = MockState(batch_delay, latency, jitter, rate_limit, stall, stall_time)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
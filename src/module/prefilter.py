@@ -0,0 +1,127 @@
+import collections
+import re
+from dataclasses import dataclass, field
+from typing import Callable
+
+from nltk.stem.snowball import SnowballStemmer
+from nltk.tokenize import wordpunct_tokenize
+
+from module.export import ExportItem, get_user
+
+# @mentions are how replies look in a chat, only invite links count along with urls
+link_regex = re.compile(r"(https?://|www\.|(t|telegram)\.me/|tg://)", re.IGNORECASE)
+cyrillic_regex = re.compile(r"[а-яё]")
+
+stemmers = {
+    "russian": SnowballStemmer("russian"),
+    "english": SnowballStemmer("english"),
+}
+
+
+def stem(word: str) -> str:
+    return stemmers["russian" if cyrillic_regex.search(word) else "english"].stem(word)
+
+
+def get_words(text: str) -> list[str]:
+    return [word.lower() for word in wordpunct_tokenize(text) if word.isalnum()]
+
+
+@dataclass
+class PrefilterScore:
+    score: float
+    benign: bool
+    features: dict[str, float] = field(default_factory=dict)
+
+
+class Prefilter(object):
+    """Cheap local signals deciding whether a chunk is worth an LLM call"""
+
+    def __init__(
+        self,
+        threshold: float,
+        weights: dict[str, float],
+        keywords: list[str],
+        warmup: int = 1,
+        max_users: int | None = None,
+        min_length: int = 0,
+    ):
+        self.threshold = threshold
+        self.weights = weights
+        self.keywords = {stem(word.lower()) for word in keywords}
+        # the first chunks see every user for the first time
+        self.warmup = warmup
+        self.chunks = 0
+        self.skipped = 0
+        self.skipped_tokens = 0
+        # least recently seen first, a live chat forgets the users quiet for longest once there are max_users
+        self.max_users = max_users
+        self.seen_users = collections.OrderedDict()
+        # short replies like "ok" or "+" repeat in any chat, only longer texts count as repeated
+        self.min_length = min_length
+
+    def get_link_density(self, items: list[ExportItem]) -> float:
+        return sum(1 for item in items if link_regex.search(item.message)) / len(items)
+
+    def get_repetition(self, items: list[ExportItem]) -> float:
+        texts = [" ".join(get_words(item.message)) for item in items]
+        texts = [text for text in texts if len(text) >= self.min_length]
+        return (len(texts) - len(set(texts))) / len(items)
+
+    def get_new_users(self, items: list[ExportItem]) -> float:
+        users = [get_user(item) for item in items]
+        new = sum(1 for user in users if user not in self.seen_users)
+        for user in users:
+            self.seen_users[user] = None
+            self.seen_users.move_to_end(user)
+        while self.max_users is not None and len(self.seen_users) > self.max_users:
+            self.seen_users.popitem(last=False)
+        if self.chunks < self.warmup:
+            return 0.0
+        return new / len(users)
+
+    def get_keyword_hits(self, items: list[ExportItem]) -> float:
+        hits = 0
+        for item in items:
+            if any(stem(word) in self.keywords for word in get_words(item.message)):
+                hits += 1
+        return hits / len(items)
+
+    @property
+    def scorers(self) -> dict[str, Callable[[list[ExportItem]], float]]:
+        return {
+            "links": self.get_link_density,
+            "repetition": self.get_repetition,
+            "new_users": self.get_new_users,
+            "keywords": self.get_keyword_hits,
+        }
+
+    def score(self, items: list[ExportItem]) -> PrefilterScore:
+        features = {}
+        for name, scorer in self.scorers.items():
+            if name in self.weights:
+                features[name] = round(scorer(items), 3)
+        self.chunks += 1
+        # any single strong signal is enough to send the chunk to the model
+        score = max((self.weights[name] * value for name, value in features.items()), default=1.0)
+        return PrefilterScore(score=round(score, 3), benign=score < self.threshold, features=features)
+
+    def record_skip(self, tokens: int):
+        self.skipped += 1
+        self.skipped_tokens += tokens
+
+    def stats(self):
+        return dict(chunks=self.chunks, skipped=self.skipped, skipped_tokens=self.skipped_tokens)
+
+
+def get_prefiltered_response(score: PrefilterScore) -> dict:
+    return {
+        "suspicious_activity_detected": False,
+        "suspicious_users": [],
+        "suspicious_messages": [],
+        "potential_bots": [],
+        "advertising_activities": [],
+        "off_topic_messages": [],
+        "manipulative_behaviors": [],
+        "conversation_health": "Normal (prefiltered)",
+        "notes": f"Skipped by the local prefilter with score {score.score}.",
+    }
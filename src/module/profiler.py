@@ -0,0 +1,64 @@
+import collections
+import pathlib
+import sys
+import threading
+import time
+
+
+def get_frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({pathlib.Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all the threads every interval seconds from a background thread"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(get_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def get_top(self, count: int = 20) -> list[tuple[str, int, int]]:
+        """(function, samples with it on the stack, samples with it on top) of the busiest functions"""
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, samples in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += samples
+            for frame in set(frames):
+                total[frame] += samples
+        return [(frame, samples, own[frame]) for frame, samples in total.most_common(count)]
+
+    def write_collapsed(self, path: pathlib.Path):
+        # the folded format of flamegraph.pl and speedscope
+        with path.open("w") as out_file:
+            for stack, samples in self.stacks.most_common():
+                out_file.write(f"{stack} {samples}\n")
+
+    def print_top(self, count: int = 20):
+        print(f"profile: {self.samples} samples every {self.interval * 1000:.0f}ms, top functions (total / own)")
+        for frame, samples, own in self.get_top(count):
+            print(f"  {samples:>7} {own:>7}  {frame}")
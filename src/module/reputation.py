@@ -0,0 +1,283 @@
+import asyncio
+import base64
+import collections
+import datetime
+import threading
+import time
+from concurrent.futures import Future, wait
+from dataclasses import asdict, dataclass
+
+import httpx
+
+from module.cache import ResponseCache
+from module.tokens import count_tokens
+from module.urls import get_url_hash
+
+VIRUSTOTAL_URL = "https://www.virustotal.com/api/v3"
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+@dataclass
+class UrlVerdict:
+    url: str
+    # ok, or why there are no engine counts: quota, timeout, pending (not waited for), error
+    status: str
+    malicious: int = 0
+    suspicious: int = 0
+    harmless: int = 0
+    undetected: int = 0
+
+    @property
+    def label(self) -> str:
+        if self.status != "ok":
+            return "unknown"
+        if self.malicious:
+            return "malicious"
+        return "suspicious" if self.suspicious else "clean"
+
+    def describe(self) -> str:
+        total = self.malicious + self.suspicious + self.harmless + self.undetected
+        return f"{self.label}, {self.malicious} malicious and {self.suspicious} suspicious of {total} engines"
+
+
+def format_verdicts(verdicts: list[UrlVerdict], max_tokens: int = 400) -> str:
+    """The prompt section with the links worth a look in at most max_tokens, the rest and the clean ones counted"""
+    flagged = [verdict for verdict in verdicts if verdict.label in ["malicious", "suspicious"]]
+    clean = sum(1 for verdict in verdicts if verdict.label == "clean")
+    if not flagged and not clean:
+        return ""
+    header = "\n\nLinks checked with VirusTotal:\n"
+    # the two counter lines at the end are short
+    budget = max_tokens - count_tokens(header) - 30
+    lines = []
+    for verdict in flagged:
+        line = f"- {verdict.url}: {verdict.describe()}"
+        budget -= count_tokens(line) + 1
+        if budget < 0:
+            break
+        lines.append(line)
+    if len(lines) < len(flagged):
+        lines.append(f"- {len(flagged) - len(lines)} more flagged links")
+    if clean:
+        lines.append(f"- {clean} other links with no detections")
+    return header + "\n".join(lines)
+
+
+class AsyncQuota(object):
+    """Requests per minute and per day of an API key, shared by the coroutines of one event loop"""
+
+    def __init__(self, rpm: int | None = None, daily: int | None = None):
+        self.rpm = rpm
+        self.daily = daily
+        self.used = 0
+        # the daily quota starts over at midnight UTC
+        self.day = datetime.datetime.now(datetime.timezone.utc).date()
+        # until when a request has to wait, read from other threads to not wait behind it
+        self.blocked_until = 0.0
+        self._times = collections.deque()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self.roll_over()
+                if self.daily and self.used >= self.daily:
+                    raise QuotaExceeded(f"{self.used} of {self.daily} daily requests used")
+                now = time.monotonic()
+                while self._times and now - self._times[0] >= 60:
+                    self._times.popleft()
+                wait = self._paused_until - now
+                if self.rpm and len(self._times) >= self.rpm:
+                    wait = max(wait, self._times[0] + 60 - now)
+                if wait <= 0:
+                    self._times.append(now)
+                    self.used += 1
+                    return
+                self.blocked_until = now + wait
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.blocked_until = max(self.blocked_until, self._paused_until)
+
+    def roll_over(self):
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+
+    def is_used_up(self) -> bool:
+        self.roll_over()
+        return bool(self.daily and self.used >= self.daily) or time.monotonic() < self.blocked_until
+
+
+def get_url_id(url: str) -> str:
+    # how VirusTotal identifies the report of a url
+    return base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+
+
+def is_reusable(future: Future) -> bool:
+    # a link that couldn't be checked is tried again by the next chunk with it
+    return not future.done() or (not future.cancelled() and future.result().status == "ok")
+
+
+def get_stats_verdict(url: str, stats: dict | None) -> UrlVerdict:
+    stats = stats or {}
+    return UrlVerdict(
+        url=url,
+        status="ok",
+        malicious=stats.get("malicious", 0),
+        suspicious=stats.get("suspicious", 0),
+        harmless=stats.get("harmless", 0),
+        undetected=stats.get("undetected", 0),
+    )
+
+
+class UrlReputation(object):
+    """VirusTotal verdicts of links, checked concurrently on a background event loop and cached by url hash"""
+
+    def __init__(
+        self,
+        api_key: str,
+        cache: ResponseCache | None = None,
+        base_url: str = VIRUSTOTAL_URL,
+        concurrency: int = 4,
+        rpm: int | None = 4,
+        daily: int | None = 500,
+        poll_interval: float = 5.0,
+        poll_max: float = 60.0,
+        timeout: float = 300.0,
+        retries: int = 3,
+        max_urls: int = 100000,
+    ):
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self.retries = retries
+        self.max_urls = max_urls
+        self.checked = collections.Counter()
+        self.urls = 0
+        # the futures of the most recently seen links, a monitor run meets new links for as long as it runs
+        self._futures: collections.OrderedDict[str, Future] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="reputation", daemon=True)
+        self._thread.start()
+
+        async def init():
+            # the asyncio primitives belong to the loop they are created in
+            self._client = httpx.AsyncClient(base_url=base_url, headers={"x-apikey": api_key}, timeout=30.0)
+            self._quota = AsyncQuota(rpm, daily)
+            self._semaphore = asyncio.Semaphore(concurrency)
+
+        asyncio.run_coroutine_threadsafe(init(), self._loop).result()
+
+    def check(self, url: str) -> Future:
+        """A future of the UrlVerdict, a url is looked up until it has a verdict, safe to call from any thread"""
+        key = get_url_hash(url)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and is_reusable(future):
+                self._futures.move_to_end(key)
+                return future
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                future = Future()
+                future.set_result(UrlVerdict(**cached))
+                self.checked["cached"] += 1
+            else:
+                future = asyncio.run_coroutine_threadsafe(self._check(url, key), self._loop)
+            self.urls += 1
+            self._futures[key] = future
+            # a forgotten link is found in the verdict cache the next time, the chunks waiting for it keep the future
+            while len(self._futures) > self.max_urls:
+                self._futures.popitem(last=False)
+        return future
+
+    def get_verdicts(self, futures: dict[str, Future], timeout: float | None = None) -> dict[str, UrlVerdict]:
+        """Waits for the verdicts up to timeout in total, the late ones are unknown for now"""
+        end = None if timeout is None else time.monotonic() + timeout
+        pending = [future for future in futures.values() if not future.done()]
+        # checks held back by the quota take minutes, a worker waiting for them only holds back the chunks behind it
+        while pending and not self._quota.is_used_up():
+            left = 1.0 if end is None else min(1.0, end - time.monotonic())
+            if left <= 0:
+                break
+            wait(pending, timeout=left)
+            pending = [future for future in pending if not future.done()]
+        status = "pending" if self._quota.is_used_up() else "timeout"
+        return {
+            url: future.result() if future.done() else UrlVerdict(url=url, status=status)
+            for url, future in futures.items()
+        }
+
+    async def _check(self, url: str, key: str) -> UrlVerdict:
+        async with self._semaphore:
+            try:
+                verdict = await asyncio.wait_for(self._get_verdict(url), self.timeout)
+            except QuotaExceeded:
+                verdict = UrlVerdict(url=url, status="quota")
+            except asyncio.TimeoutError:
+                verdict = UrlVerdict(url=url, status="timeout")
+            except Exception:
+                # a failed future would stay in _futures and fail every later chunk with the link
+                verdict = UrlVerdict(url=url, status="error")
+        with self._lock:
+            self.checked[verdict.status] += 1
+        # only an answer is cached, a link that couldn't be checked is tried again next run
+        if verdict.status == "ok" and self.cache is not None:
+            self.cache.set(key, asdict(verdict))
+        return verdict
+
+    async def _get_verdict(self, url: str) -> UrlVerdict:
+        # a link somebody already submitted costs one request instead of a submit and the polling
+        response = await self._request("GET", f"/urls/{get_url_id(url)}")
+        if response.status_code == 200:
+            attributes = response.json()["data"]["attributes"]
+            if attributes.get("last_analysis_stats"):
+                return get_stats_verdict(url, attributes["last_analysis_stats"])
+        elif response.status_code != 404:
+            response.raise_for_status()
+
+        analysis_id = await self.submit_url(url)
+        delay = self.poll_interval
+        while True:
+            await asyncio.sleep(delay)
+            attributes = await self.get_analysis_results(analysis_id)
+            if attributes["status"] == "completed":
+                return get_stats_verdict(url, attributes.get("stats"))
+            delay = min(delay * 2, self.poll_max)
+
+    async def submit_url(self, url: str) -> str:
+        response = await self._request("POST", "/urls", data={"url": url})
+        response.raise_for_status()
+        return response.json()["data"]["id"]
+
+    async def get_analysis_results(self, analysis_id: str) -> dict:
+        response = await self._request("GET", f"/analyses/{analysis_id}")
+        response.raise_for_status()
+        return response.json()["data"]["attributes"]
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            await self._quota.acquire()
+            response = await self._client.request(method, path, **kwargs)
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+            # the per minute quota of the key is shared with whatever else uses it, wait for the next window
+            self._quota.pause(float(response.headers.get("retry-after") or 60))
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(urls=self.urls, **self.checked)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
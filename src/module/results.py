@@ -0,0 +1,205 @@
+import datetime
+import pathlib
+import sqlite3
+import threading
+
+from module.utils import json_dump, json_load
+
+# analyzer response fields stored as rows of their own
+USER_FIELDS = {"suspicious_users": "suspicious", "potential_bots": "bot"}
+MESSAGE_FIELDS = {
+    "suspicious_messages": "suspicious",
+    "advertising_activities": "advertising",
+    "off_topic_messages": "off_topic",
+    "manipulative_behaviors": "manipulative",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    chat TEXT NOT NULL,
+    agent TEXT,
+    run TEXT NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    date_from TEXT NOT NULL,
+    date_to TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    tokens INTEGER NOT NULL,
+    encoding TEXT,
+    prefilter_score REAL,
+    prefiltered INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    suspicious INTEGER,
+    health TEXT,
+    notes TEXT,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS chunks_chat ON chunks (chat, first_id);
+CREATE INDEX IF NOT EXISTS chunks_suspicious ON chunks (suspicious, chat);
+CREATE TABLE IF NOT EXISTS flagged_users (
+    chunk_id INTEGER NOT NULL REFERENCES chunks (id) ON DELETE CASCADE,
+    user TEXT NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flagged_users_user ON flagged_users (user, kind);
+CREATE INDEX IF NOT EXISTS flagged_users_chunk ON flagged_users (chunk_id);
+CREATE TABLE IF NOT EXISTS flagged_messages (
+    chunk_id INTEGER NOT NULL REFERENCES chunks (id) ON DELETE CASCADE,
+    text TEXT NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flagged_messages_chunk ON flagged_messages (chunk_id, kind);
+CREATE INDEX IF NOT EXISTS flagged_messages_kind ON flagged_messages (kind);
+"""
+
+# a chunk analyzed again (a rerun, --resume, a retry round) replaces its earlier row
+UNIQUE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS chunks_unique ON chunks (chat, agent, first_id, last_id)"
+
+
+class ResultStore(object):
+    """Indexed SQLite tables of analyzed chunks and the users and messages their responses flagged"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # a crash may lose the last chunks but never corrupts the file, the checkpoint is behind them anyway
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_unique'").fetchone()
+        if exists is not None:
+            return
+        # stores written before the unique index may hold a chunk several times, the latest row wins
+        with self._db:
+            self._db.execute("UPDATE chunks SET agent = '' WHERE agent IS NULL")
+            self._db.execute(
+                """
+                DELETE FROM chunks WHERE id NOT IN (
+                    SELECT MAX(id) FROM chunks GROUP BY chat, agent, first_id, last_id
+                )
+                """
+            )
+            self._db.execute(UNIQUE_INDEX)
+
+    def add(
+        self,
+        chat: str,
+        agent: str | None,
+        run: datetime.datetime,
+        chunk,
+        response: dict | None,
+        error: Exception | None,
+        encoding: str | None = None,
+    ) -> int:
+        prefilter = chunk.prefilter
+        response = response or {}
+        with self._lock, self._db:
+            chunk_id = self._db.execute(
+                """
+                INSERT INTO chunks (
+                    chat, agent, run, first_id, last_id, date_from, date_to, count, tokens, encoding,
+                    prefilter_score, prefiltered, error, suspicious, health, notes, response
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat, agent, first_id, last_id) DO UPDATE SET
+                    run = excluded.run, date_from = excluded.date_from, date_to = excluded.date_to,
+                    count = excluded.count, tokens = excluded.tokens, encoding = excluded.encoding,
+                    prefilter_score = excluded.prefilter_score, prefiltered = excluded.prefiltered,
+                    error = excluded.error, suspicious = excluded.suspicious, health = excluded.health,
+                    notes = excluded.notes, response = excluded.response
+                RETURNING id
+                """,
+                (
+                    chat,
+                    # NULLs never collide in a unique index
+                    agent or "",
+                    run.isoformat(),
+                    chunk.items[0].id,
+                    chunk.items[-1].id,
+                    chunk.items[0].date.isoformat(),
+                    chunk.items[-1].date.isoformat(),
+                    len(chunk.items),
+                    chunk.tokens,
+                    encoding,
+                    prefilter.score if prefilter is not None else None,
+                    int(prefilter is not None and prefilter.benign),
+                    repr(error) if error is not None else None,
+                    int(response["suspicious_activity_detected"])
+                    if "suspicious_activity_detected" in response
+                    else None,
+                    response.get("conversation_health"),
+                    response.get("notes"),
+                    json_dump(response) if response else None,
+                ),
+            ).fetchone()[0]
+            # the flags of the replaced response go with it
+            self._db.execute("DELETE FROM flagged_users WHERE chunk_id = ?", (chunk_id,))
+            self._db.execute("DELETE FROM flagged_messages WHERE chunk_id = ?", (chunk_id,))
+            self._db.executemany(
+                "INSERT INTO flagged_users (chunk_id, user, kind) VALUES (?, ?, ?)",
+                [
+                    (chunk_id, str(user), kind)
+                    for field, kind in USER_FIELDS.items()
+                    for user in response.get(field) or []
+                ],
+            )
+            self._db.executemany(
+                "INSERT INTO flagged_messages (chunk_id, text, kind) VALUES (?, ?, ?)",
+                [
+                    (chunk_id, str(text), kind)
+                    for field, kind in MESSAGE_FIELDS.items()
+                    for text in response.get(field) or []
+                ],
+            )
+        return chunk_id
+
+    def _get_chunks(self, query: str, params: tuple) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        out = []
+        for row in rows:
+            row = dict(row)
+            row["response"] = json_load(row["response"]) if row["response"] is not None else None
+            out.append(row)
+        return out
+
+    def get_user_chunks(self, user: str, chat: str | None = None) -> list[dict]:
+        """Chunks where the user was flagged as suspicious or as a bot"""
+        return self._get_chunks(
+            """
+            SELECT chunks.*, GROUP_CONCAT(DISTINCT flagged_users.kind) AS kinds FROM flagged_users
+            JOIN chunks ON chunks.id = flagged_users.chunk_id
+            WHERE flagged_users.user = ? AND (? IS NULL OR chunks.chat = ?)
+            GROUP BY chunks.id ORDER BY chunks.chat, chunks.first_id
+            """,
+            (user, chat, chat),
+        )
+
+    def get_suspicious_chunks(self, chat: str | None = None) -> list[dict]:
+        return self._get_chunks(
+            "SELECT * FROM chunks WHERE suspicious = 1 AND (? IS NULL OR chat = ?) ORDER BY chat, first_id",
+            (chat, chat),
+        )
+
+    def get_top_users(self, chat: str | None = None, limit: int = 20) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                """
+                SELECT flagged_users.user, COUNT(DISTINCT chunk_id) AS chunks FROM flagged_users
+                JOIN chunks ON chunks.id = flagged_users.chunk_id
+                WHERE ? IS NULL OR chunks.chat = ?
+                GROUP BY flagged_users.user ORDER BY chunks DESC LIMIT ?
+                """,
+                (chat, chat, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self._db.close()
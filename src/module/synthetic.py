@@ -0,0 +1,74 @@
+import datetime
+import pathlib
+import random
+
+from module.utils import json_dump
+
+WORDS = (
+    "привет всем кто знает где купить билеты сегодня вечером спасибо новости работа доход канал подписывайтесь "
+    "hello crypto free bonus link"
+).split()
+
+
+def get_synthetic_message(message_id: int, date: datetime.datetime, user_id: int, text: str) -> dict:
+    """Mirrors the shape of telethon's Message.to_dict() as written by export-chat.py"""
+    return {
+        "_": "Message",
+        "id": message_id,
+        "peer_id": {"_": "PeerChannel", "channel_id": 2168150207},
+        "date": date,
+        "message": text,
+        "out": False,
+        "mentioned": False,
+        "media_unread": False,
+        "silent": False,
+        "post": False,
+        "from_scheduled": False,
+        "legacy": False,
+        "edit_hide": False,
+        "pinned": False,
+        "noforwards": False,
+        "invert_media": False,
+        "offline": False,
+        "from_id": {"_": "PeerUser", "user_id": user_id},
+        "from_boosts_applied": None,
+        "saved_peer_id": None,
+        "fwd_from": None,
+        "via_bot_id": None,
+        "via_business_bot_id": None,
+        "reply_to": None,
+        "media": None,
+        "reply_markup": None,
+        "entities": [],
+        "views": None,
+        "forwards": None,
+        "replies": None,
+        "edit_date": None,
+        "post_author": None,
+        "grouped_id": None,
+        "reactions": None,
+        "restriction_reason": [],
+        "ttl_period": None,
+        "quick_reply_shortcut_id": None,
+        "effect": None,
+        "factcheck": None,
+    }
+
+
+def write_synthetic_export(
+    path: pathlib.Path,
+    count: int,
+    users: int = 1000,
+    seed: int = 0,
+    message_length: int = 12,
+    start: datetime.datetime | None = None,
+):
+    rng = random.Random(seed)
+    start = start or datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    with path.open("w") as out_file:
+        # newest first, like client.iter_messages()
+        for message_id in range(count, 0, -1):
+            date = start + datetime.timedelta(seconds=message_id * 20)
+            text = " ".join(rng.choices(WORDS, k=rng.randint(1, message_length * 2)))
+            message = get_synthetic_message(message_id, date, rng.randint(1, users), text)
+            out_file.write("{}\n".format(json_dump(message)))
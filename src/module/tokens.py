@@ -0,0 +1,45 @@
+import functools
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# approximate per character token rates of cl100k_base, used when tiktoken can't load the encoding
+latin_regex = re.compile(r"[A-Za-z]")
+cyrillic_regex = re.compile(r"[Ѐ-ӿ]")
+digit_regex = re.compile(r"\d")
+space_regex = re.compile(r"\s")
+
+LATIN_RATE = 0.25
+CYRILLIC_RATE = 0.45
+DIGIT_RATE = 0.34
+SYMBOL_RATE = 0.6
+
+
+@functools.cache
+def get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        # unknown model, or the encoding file can't be downloaded
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    latin = len(latin_regex.findall(text))
+    cyrillic = len(cyrillic_regex.findall(text))
+    digits = len(digit_regex.findall(text))
+    spaces = len(space_regex.findall(text))
+    symbols = len(text) - latin - cyrillic - digits - spaces
+    return int(latin * LATIN_RATE + cyrillic * CYRILLIC_RATE + digits * DIGIT_RATE + symbols * SYMBOL_RATE) + 1
+
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,52 @@
+import hashlib
+import re
+import urllib.parse
+
+url_regex = re.compile(r"\b(?:https?://|www\.|t\.me/)[^\s<>\"'`]+", re.IGNORECASE)
+
+# closing punctuation of the sentence around a link rather than part of it
+TRAILING_CHARS = ".,:;!?)]}>»\"'…"
+
+# query parameters that only track the click, the same page without them
+TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|yclid|mc_cid|mc_eid|igshid|ref_src)$", re.IGNORECASE)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str | None:
+    """The canonical form of a link, so the spellings of one page are checked once; None when it isn't a url"""
+    url = url.rstrip(TRAILING_CHARS)
+    if not re.match(r"^https?://", url, re.IGNORECASE):
+        url = f"http://{url}"
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.hostname or "").rstrip(".")
+        port = parts.port
+    except ValueError:
+        return None
+    if not host or "." not in host:
+        return None
+    try:
+        host = host.encode("idna").decode("ascii")
+    except UnicodeError:
+        pass
+    scheme = parts.scheme.lower()
+    netloc = host if port is None or port == DEFAULT_PORTS.get(scheme) else f"{host}:{port}"
+    query = sorted(
+        (key, value)
+        for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(key)
+    )
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or "/", urllib.parse.urlencode(query), ""))
+
+
+def extract_urls(text: str | None) -> list[str]:
+    """Normalized links of a message in the order they appear, without repeats"""
+    if not text:
+        return []
+    urls = (normalize_url(match.group(0)) for match in url_regex.finditer(text))
+    return list(dict.fromkeys(url for url in urls if url is not None))
+
+
+def get_url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
@@ -1,6 +1,8 @@
 import dataclasses
 import datetime
+import functools
 import json
+import mmap
 import os
 import pathlib
 import subprocess
@@ -8,6 +10,8 @@ from io import StringIO
 
 from ruamel.yaml import YAML, RoundTripRepresenter
 
+from module.compression import gzip_readline, is_gzip
+
 
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -47,31 +51,42 @@ def yaml_load(stream):
     return yaml.load_all(stream)
 
 
-def yaml_dump(data: list[any]):
+@functools.cache
+def get_yaml() -> YAML:
+    # building the dumper is the expensive part of yaml_dump(), it is reused between calls
     yaml = YAML()
     yaml.representer.add_representer(str, repr_str)
     yaml.representer.add_representer(type(None), repr_none)
+    # yaml.compact(seq_seq=False, seq_map=False)
+    yaml.compact()
+    return yaml
+
 
+def yaml_dump(data: list[any]):
     prepared_data = json.loads(json.dumps(data, cls=EnhancedJSONEncoder))
 
     stream = StringIO()
-    # yaml.compact(seq_seq=False, seq_map=False)
-    yaml.compact()
-    yaml.dump_all(prepared_data, stream)
+    get_yaml().dump_all(prepared_data, stream)
 
     return stream.getvalue()
 
 
-def reverse_readline(filename, buf_size=8192):
-    """A generator that returns the lines of a file in reverse order"""
+def reverse_readline(filename, buf_size=8192, start=0, end=None):
+    """A generator that returns the lines of a file (or of its [start, end) byte range) in reverse order"""
+    if start == 0 and end is None and is_gzip(filename):
+        for line in gzip_readline(filename, reverse=True):
+            yield line.decode()
+        return
     with open(filename, "rb") as fh:
         segment = None
         offset = 0
-        fh.seek(0, os.SEEK_END)
-        file_size = remaining_size = fh.tell()
+        if end is None:
+            fh.seek(0, os.SEEK_END)
+            end = fh.tell()
+        file_size = remaining_size = end - start
         while remaining_size > 0:
             offset = min(file_size, offset + buf_size)
-            fh.seek(file_size - offset)
+            fh.seek(start + file_size - offset)
             buffer = fh.read(min(remaining_size, buf_size))
             # remove file's last "\n" if it exists, only for the first buffer
             if remaining_size == file_size and buffer[-1] == ord("\n"):
@@ -92,6 +107,35 @@ def reverse_readline(filename, buf_size=8192):
             yield segment.decode()
 
 
+def mmap_readline(filename, reverse=False, start=0, end=None):
+    """A generator that returns memoryview slices of the lines of a memory-mapped file, decoding is up to the caller"""
+    with open(filename, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return
+        # the map outlives the file object and is released with the last slice referencing it
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    end = size if end is None else end
+
+    if reverse:
+        pos = end
+        while pos > start:
+            newline = mm.rfind(b"\n", start, pos)
+            line_start = newline + 1 if newline != -1 else start
+            if line_start < pos:
+                yield view[line_start:pos]
+            pos = line_start - 1
+    else:
+        pos = start
+        while pos < end:
+            newline = mm.find(b"\n", pos, end)
+            newline = end if newline == -1 else newline
+            if newline > pos:
+                yield view[pos:newline]
+            pos = newline + 1
+
+
 def get_pass(name: str) -> str:
     out = os.environ.get(name)
     if out is None:
@@ -39,7 +39,7 @@ def log(log_file: TextIO, text: str):
 
 def filter_items(items):
     for item in items:
-        if item.from_id.from_type == "PeerChannel":
+        if item.from_id is not None and item.from_id.from_type == "PeerChannel":
             continue
         if not item.message:
             continue
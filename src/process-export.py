@@ -1,19 +1,51 @@
 import argparse
+import asyncio
+import copy
 import datetime
+import itertools
 import json
 import logging
 import pathlib
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from signal import SIG_DFL, SIGINT, SIGPIPE, signal
 from typing import Generator, TextIO
 
 import openai
-from autogen import ConversableAgent
+import telethon
 from pytimeparse.timeparse import timeparse
 
+from module.batch import (
+    get_batch_request,
+    get_batch_results,
+    submit_batch,
+    wait_batch,
+    write_batch_file,
+)
+from module.cache import ResponseCache
+from module.checkpoint import Checkpoint, load_checkpoint, save_checkpoint
 from module.config import get_config
-from module.export import get_items, get_user
+from module.dedup import DuplicateIndex
+from module.dispatch import (
+    LatencyWindow,
+    RateLimiter,
+    call_with_backoff,
+    dispatch,
+    get_time_left,
+    hedge,
+)
+from module.encoding import ENCODERS, get_encoder
+from module.export import ExportItem, decode_item, get_export_paths, get_items, get_user
+from module.llm import LLMClient
+from module.metrics import Metrics
+from module.prefilter import Prefilter, PrefilterScore, get_prefiltered_response
+from module.profiler import SamplingProfiler
+from module.reputation import UrlReputation, format_verdicts
+from module.results import ResultStore
+from module.tokens import count_tokens
+from module.urls import extract_urls
 from module.utils import get_pass, indent, json_dump, json_load, yaml_dump
 
 signal(SIGPIPE, SIG_DFL)
@@ -28,25 +60,94 @@ signal(SIGINT, sigint_handler)
 logging.getLogger("autogen.oai.client").setLevel(logging.ERROR)
 
 
+def parse_date(value: str) -> datetime.datetime:
+    date = datetime.datetime.fromisoformat(value)
+    # export dates are UTC
+    return date if date.tzinfo is not None else date.replace(tzinfo=datetime.timezone.utc)
+
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument("--input", "-i")
 argparser.add_argument("--agent", "-a")
 argparser.add_argument("--no-log", action="store_true")
+argparser.add_argument("--no-results", action="store_true")
+argparser.add_argument("--concurrency", "-c", type=int)
+argparser.add_argument("--no-cache", action="store_true")
+argparser.add_argument("--resume", action="store_true")
+argparser.add_argument("--min-id", type=int)
+argparser.add_argument("--since", type=parse_date)
+argparser.add_argument("--until", type=parse_date)
+argparser.add_argument("--workers", "-w", type=int, default=1)
+argparser.add_argument("--prefilter", action="store_true")
+argparser.add_argument("--dedup", action="store_true")
+argparser.add_argument("--prompt-encoding", choices=list(ENCODERS))
+argparser.add_argument("--batch", action="store_true")
+argparser.add_argument("--monitor", "-m", action="append")
+argparser.add_argument("--log-usage", action="store_true")
+argparser.add_argument("--cascade", action="store_true")
+argparser.add_argument("--model")
+argparser.add_argument("--profile", action="store_true")
+argparser.add_argument("--hedge", action="store_true")
+argparser.add_argument("--check-urls", action="store_true")
 args = argparser.parse_args()
+if args.cascade and args.batch:
+    argparser.error("--cascade needs the answer of a tier before asking the next one, it can't run as --batch")
 
 root_dir = pathlib.Path(__file__).parents[1]
 config = get_config([root_dir / "config/global.yaml", root_dir / "local.yaml"], root_dir)
+encoder = get_encoder(args.prompt_encoding or config.prompt.encoding)
+
+cache = None
+if not args.no_cache:
+    cache = ResponseCache(
+        config.root_dir / config.cache.path,
+        max_size=config.cache.max_size_mb * 1024 * 1024,
+        max_age=timeparse(config.cache.max_age),
+    )
+
+metrics = Metrics(config.llm.prices.to_dict())
+concurrency = args.concurrency or config.llm.concurrency
+# a hedged request holds a second connection until the slower copy is done
+llm = LLMClient(pool_size=concurrency * 2 if args.hedge else concurrency, timeout=timeparse(config.llm.timeout))
+# one rate limiter for all the chats and the hedges, the quota is per API key
+limiter = RateLimiter(config.llm.rpm, config.llm.tpm)
 
+hedge_window = None
+hedge_executor = None
+if args.hedge:
+    hedge_window = LatencyWindow(config.llm.hedge.percentile, config.llm.hedge.window, config.llm.hedge.min_samples)
+    hedge_executor = ThreadPoolExecutor(concurrency * 2)
 
-def log(log_file: TextIO, text: str):
-    print(text)
+reputation = None
+if args.check_urls:
+    reputation = UrlReputation(
+        get_pass("VIRUS_TOTAL_API_KEY"),
+        ResponseCache(config.root_dir / config.urls.cache_path, max_age=timeparse(config.urls.max_age)),
+        base_url=config.urls.base_url,
+        concurrency=config.urls.concurrency,
+        rpm=config.urls.rpm,
+        daily=config.urls.daily,
+        poll_interval=timeparse(config.urls.poll_interval),
+        poll_max=timeparse(config.urls.poll_max),
+        timeout=timeparse(config.urls.timeout),
+        max_urls=config.urls.max_urls,
+    )
+
+store = None
+if not args.no_results:
+    store = ResultStore(config.root_dir / config.results.path)
+
+
+def log(log_file: TextIO, text: str, echo: bool = True):
+    if echo:
+        print(text)
     if not args.no_log:
         log_file.write(f"{text}\n")
 
 
 def filter_items(items):
     for item in items:
-        if item.from_id.from_type == "PeerChannel":
+        if item.from_id is not None and item.from_id.from_type == "PeerChannel":
             continue
         if not item.message:
             continue
@@ -60,163 +161,876 @@ class MessageChunk:
     date: str
 
 
-def ask_gpt(str_message: str):
-    openai.api_key = get_pass("OPENAI_API_KEY")
-    functions = [
-        {
-            "name": "analyzer",
-            "description": "Analyze Telegram messages for suspicious activity and overall conversation health.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "suspicious_activity_detected": {
-                        "type": "boolean",
-                        "description": "Indicates if any suspicious activity was detected.",
-                    },
-                    "suspicious_users": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of usernames that exhibit suspicious behavior.",
-                    },
-                    "suspicious_messages": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of messages that are considered suspicious.",
-                    },
-                    "potential_bots": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of usernames that may be bots.",
-                    },
-                    "advertising_activities": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of messages containing advertising or spam.",
-                    },
-                    "off_topic_messages": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of messages that are off-topic.",
-                    },
-                    "manipulative_behaviors": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "Descriptions of any manipulative behaviors detected.",
-                    },
-                    "conversation_health": {
-                        "type": "string",
-                        "enum": ["Normal", "Suspicious"],
-                        "description": "Overall evaluation of the conversation: 'Normal' or 'Suspicious'.",
-                    },
-                    "notes": {
-                        "type": "string",
-                        "description": "Additional notes or comments about the conversation analysis.",
-                    },
+@dataclass
+class DuplicateMessageChunk(MessageChunk):
+    # near-identical copies collapsed into the first one: in this chunk, posted by, in the export so far
+    count: int
+    users: list[str]
+    total: int
+
+
+@dataclass
+class Chunk:
+    items: list[ExportItem]
+    messages: list[MessageChunk]
+    tokens: int = 0
+    prefilter: PrefilterScore | None = None
+    usage: dict | None = None
+    # the retry round that analyzed it, 0 for the first pass
+    retries: int = 0
+    # in checkpoint.chunks already, a --resume retry of a chunk an earlier run logged as an error
+    counted: bool = False
+    # --check-urls: url -> future of its verdict, then the verdicts that went into the prompt
+    urls: dict | None = None
+    verdicts: list | None = None
+    urls_tokens: int = 0
+
+
+ANALYZER_FUNCTIONS = [
+    {
+        "name": "analyzer",
+        "description": "Analyze Telegram messages for suspicious activity and overall conversation health.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "suspicious_activity_detected": {
+                    "type": "boolean",
+                    "description": "Indicates if any suspicious activity was detected.",
+                },
+                "suspicious_users": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of usernames that exhibit suspicious behavior.",
+                },
+                "suspicious_messages": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of messages that are considered suspicious.",
+                },
+                "potential_bots": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of usernames that may be bots.",
+                },
+                "advertising_activities": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of messages containing advertising or spam.",
+                },
+                "off_topic_messages": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of messages that are off-topic.",
+                },
+                "manipulative_behaviors": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Descriptions of any manipulative behaviors detected.",
+                },
+                "conversation_health": {
+                    "type": "string",
+                    "enum": ["Normal", "Suspicious"],
+                    "description": "Overall evaluation of the conversation: 'Normal' or 'Suspicious'.",
+                },
+                "notes": {
+                    "type": "string",
+                    "description": "Additional notes or comments about the conversation analysis.",
                 },
-                "required": [
-                    "suspicious_activity_detected",
-                    "suspicious_users",
-                    "suspicious_messages",
-                    "potential_bots",
-                    "advertising_activities",
-                    "off_topic_messages",
-                    "manipulative_behaviors",
-                    "conversation_health",
-                    "notes",
-                ],
             },
-        }
-    ]
+            "required": [
+                "suspicious_activity_detected",
+                "suspicious_users",
+                "suspicious_messages",
+                "potential_bots",
+                "advertising_activities",
+                "off_topic_messages",
+                "manipulative_behaviors",
+                "conversation_health",
+                "notes",
+            ],
+        },
+    }
+]
+
+
+# the cheaper tiers of --cascade also rate how sure they are, to know when to escalate
+CASCADE_FUNCTIONS = copy.deepcopy(ANALYZER_FUNCTIONS)
+CASCADE_FUNCTIONS[0]["parameters"]["properties"]["confidence"] = {
+    "type": "number",
+    "description": "How confident the analysis is, from 0 (guess) to 1 (certain).",
+}
+CASCADE_FUNCTIONS[0]["parameters"]["required"].append("confidence")
+
+MODEL = args.model or config.llm.model
+
 
+def get_request(str_message: str, model: str = MODEL, functions: list[dict] = ANALYZER_FUNCTIONS):
     messages = [{"role": "user", "content": str_message}]
+    return dict(model=model, messages=messages, functions=functions, function_call={"name": "analyzer"})
 
-    response = openai.chat.completions.create(
-        model="gpt-4", messages=messages, functions=functions, function_call={"name": "analyzer"}
-    )
 
-    function_call = response.choices[0].message.function_call
-    if function_call and function_call.name == "analyzer":
-        arguments = json.loads(function_call.arguments)
-        return arguments
+def get_cached(str_message: str, model: str = MODEL, functions: list[dict] = ANALYZER_FUNCTIONS):
+    if cache is None:
+        return None
+    return cache.get(cache.get_key(model, functions, str_message))
 
 
-def get_messages_chunk(data_path: pathlib.Path) -> Generator[list[MessageChunk], None, None]:
-    time_max = timeparse(config.prompt.messages.time_max)
-    time_min = timeparse(config.prompt.messages.time_max)
+def set_cached(str_message: str, arguments: dict, model: str = MODEL, functions: list[dict] = ANALYZER_FUNCTIONS):
+    if cache is not None:
+        cache.set(cache.get_key(model, functions, str_message), arguments)
 
-    chunk = []
-    start_time = None
 
-    for index, item in enumerate(filter_items(get_items(data_path))):
-        start_time = start_time or item.date
-        chunk.append(
-            MessageChunk(
-                userID=get_user(item),
-                text=item.message,
+def ask_gpt(
+    str_message: str,
+    usage: dict | None = None,
+    model: str = MODEL,
+    functions: list[dict] = ANALYZER_FUNCTIONS,
+    tokens: int | None = None,
+):
+    """usage, when given, gets the model, latency and token counts of the call, tokens are taken from the limiter"""
+    cached = get_cached(str_message, model, functions)
+    if cached is not None:
+        if usage is not None:
+            usage.update(model=model, cached=True)
+        return cached
+
+    if tokens is not None:
+        limiter.acquire(tokens)
+    if hedge_window is not None:
+        arguments, call_usage = ask_hedged(str_message, model, functions, get_time_left())
+    else:
+        call_usage = {}
+        arguments = llm.analyze(str_message, model, functions, call_usage, get_time_left())
+    metrics.add_time("api", call_usage["latency"])
+    if usage is not None:
+        usage.update(call_usage)
+    if arguments is not None:
+        # a hedge to llm.hedge.model is answered by that model, its answer is not the one of the model asked for
+        set_cached(str_message, arguments, call_usage["model"], functions)
+    return arguments
+
+
+def ask_hedged(str_message: str, model: str, functions: list[dict], timeout: float | None) -> tuple[dict | None, dict]:
+    """Sends a copy of a request slower than the hedge percentile, to llm.hedge.model if set, the first answer wins"""
+    usages = [{}, {}]
+    start = time.monotonic()
+    backup_model = config.llm.hedge.model or model
+
+    def get_timeout():
+        return None if timeout is None else timeout - (time.monotonic() - start)
+
+    def primary():
+        return llm.analyze(str_message, model, functions, usages[0], get_timeout())
+
+    def backup():
+        metrics.add_count("hedged")
+        limiter.acquire(count_tokens(str_message) + config.llm.max_tokens)
+        return llm.analyze(str_message, backup_model, functions, usages[1], get_timeout())
+
+    def on_lost(index: int):
+        # the slower copy is paid for too
+        metrics.add_usage(dict(usages[index], hedge="lost"))
+
+    index, arguments = hedge(primary, backup, hedge_window.get_threshold(), hedge_executor, on_lost)
+    hedge_window.add(time.monotonic() - start)
+    if index == 1:
+        metrics.add_count("hedge_won")
+        usages[1]["hedge"] = "won"
+    return arguments, usages[index]
+
+
+def is_escalated(response: dict | None, min_confidence: float) -> bool:
+    if response is None:
+        return True
+    return bool(response.get("suspicious_activity_detected")) or response.get("confidence", 0) < min_confidence
+
+
+def ask_cascade(str_message: str, usage: dict):
+    """Asks the cascade.tiers models from the cheapest, the first confident and clean answer ends it"""
+    tiers = config.cascade.tiers
+    # every tier is a request of its own against the rate limit, get_chunk_cost() leaves them to this loop
+    tokens = count_tokens(str_message) + config.llm.max_tokens
+    usage["calls"] = []
+    for index, tier in enumerate(tiers):
+        last = index == len(tiers) - 1
+        tier_usage = {}
+        try:
+            response = ask_gpt(
+                str_message, tier_usage, tier["model"], ANALYZER_FUNCTIONS if last else CASCADE_FUNCTIONS, tokens
+            )
+        except openai.OpenAIError as e:
+            # a failing cheap tier is not a reason to give up on the chunk, a rate limit is retried by
+            # call_with_backoff() like any other call
+            if last or isinstance(e, openai.RateLimitError):
+                raise
+            response = None
+        finally:
+            # the tiers asked before a failure are paid for all the same
+            if tier_usage:
+                metrics.add_usage(tier_usage)
+                usage["calls"].append(tier_usage)
+        if last or not is_escalated(response, tier.get("min_confidence", 0)):
+            usage.update(tier=index, model=tier["model"])
+            return response
+
+
+def truncate(text: str, max_length: int):
+    return text if len(text) <= max_length else f"{text[:max_length]}…"
+
+
+def get_message_tokens(message: MessageChunk):
+    # the message as it appears in the prompt plus the separator
+    return count_tokens(encoder.encode_message(message)) + 1
+
+
+class ChunkBuilder(object):
+    """Incremental time/count windowing of messages into chunks that fit the prompt token budget"""
+
+    def __init__(self, duplicates: DuplicateIndex | None = None):
+        self.duplicates = duplicates
+        self.time_max = timeparse(config.prompt.messages.time_max)
+        self.time_min = timeparse(config.prompt.messages.time_min)
+        # --check-urls appends up to urls.max_tokens of verdicts to the prompt
+        self.token_budget = config.prompt.messages.token_budget - (config.urls.max_tokens if args.check_urls else 0)
+        self.base_tokens = count_tokens(encoder.encode([])[0])
+        self.reset()
+
+    def reset(self):
+        self.items = []
+        self.chunk = []
+        self.positions = {}
+        self.tokens = self.base_tokens
+        self.start_time = None
+
+    def pop(self) -> Chunk:
+        chunk = Chunk(items=self.items, messages=self.chunk, tokens=self.tokens)
+        self.reset()
+        return chunk
+
+    def get_age(self, now: datetime.datetime) -> float:
+        """Seconds since the first message of the open window"""
+        return (now - self.items[0].date).total_seconds() if self.items else 0.0
+
+    def add(self, item: ExportItem) -> list[Chunk]:
+        """Adds the message and returns the chunks it closed"""
+        closed = []
+        user = get_user(item)
+        group = self.duplicates.add(item.message, user) if self.duplicates is not None else None
+
+        if group is not None and group.id in self.positions:
+            # collapse into the copy already in this chunk, it grows by a few tokens at most
+            position = self.positions[group.id]
+            message = self.chunk[position]
+            count, users = (
+                (message.count, message.users) if isinstance(message, DuplicateMessageChunk) else (1, [message.userID])
+            )
+            users = users if user in users else users + [user]
+            self.chunk[position] = DuplicateMessageChunk(
+                userID=message.userID,
+                text=message.text,
+                date=message.date,
+                count=count + 1,
+                users=users[: config.dedup.max_users],
+                total=group.count,
+            )
+            self.tokens += get_message_tokens(self.chunk[position]) - get_message_tokens(message)
+        else:
+            message = MessageChunk(
+                userID=user,
+                text=truncate(item.message, config.prompt.messages.max_length),
                 date=item.date.strftime("%Y-%m-%d %H:%M:%S"),
             )
-        )
+            if group is not None and group.count > 1:
+                message = DuplicateMessageChunk(
+                    userID=message.userID,
+                    text=message.text,
+                    date=message.date,
+                    count=1,
+                    users=[user],
+                    total=group.count,
+                )
+            message_tokens = get_message_tokens(message)
+
+            # the context window is a hard limit, close the chunk even if it is shorter than count_min/time_min
+            if self.chunk and self.tokens + message_tokens > self.token_budget:
+                closed.append(self.pop())
+
+            if group is not None:
+                self.positions[group.id] = len(self.chunk)
+            self.chunk.append(message)
+            self.tokens += message_tokens
 
-        delta = (item.date - start_time).total_seconds()
+        self.start_time = self.start_time or item.date
+        self.items.append(item)
+
+        delta = (item.date - self.start_time).total_seconds()
 
         if (
-            (len(chunk) >= config.prompt.messages.count_max or delta > time_max)
-            and len(chunk) >= config.prompt.messages.count_min
-            and delta > time_min
+            (len(self.chunk) >= config.prompt.messages.count_max or delta > self.time_max)
+            and len(self.chunk) >= config.prompt.messages.count_min
+            and delta > self.time_min
         ):
-            yield chunk
-            chunk = []
-            start_time = None
+            closed.append(self.pop())
+        return closed
+
+
+def get_messages_chunk(
+    data_path: pathlib.Path,
+    min_id: int | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    duplicates: DuplicateIndex | None = None,
+) -> Generator[Chunk, None, None]:
+    builder = ChunkBuilder(duplicates)
+    items = metrics.timed("read", get_items(data_path, min_id, since, until, workers=args.workers))
+    for item in filter_items(items):
+        with metrics.timer("chunk"):
+            chunks = builder.add(item)
+        yield from chunks
 
 
 def get_agent(name: str):
-    config_list = {
-        "gpt-4": dict(model="gpt-4", api_key=get_pass("OPENAI_API_KEY")),
-        "gemini-pro": dict(
-            model="gemini-pro",
-            api_type="google",
-            api_key=get_pass("GEMINI_API_KEY"),
-            generation_config=dict(response_mime_type="application/json"),
-        ),
-    }
-    return ConversableAgent(
-        "chatbot",
-        llm_config={"config_list": [config_list[name]]},
-        # system_message="",
-        function_map=None,
-        code_execution_config=False,
-        human_input_mode="NEVER",
-    )
+    return llm.get_agent(name)
 
 
-def process_messages_chunk(now: datetime.datetime, log_file: TextIO, messages_chunk: list[MessageChunk]):
-    log(log_file, "---")
-    log(log_file, "messages:")
-    log(log_file, f"  count: {len(messages_chunk)}")
-    log(log_file, f"  from: {messages_chunk[0].date}")
-    log(log_file, f"  to: {messages_chunk[-1].date}")
+def prefilter_chunks(chunks, prefilter: Prefilter):
+    for chunk in chunks:
+        with metrics.timer("prefilter"):
+            chunk.prefilter = prefilter.score(chunk.items)
+        if chunk.prefilter.benign:
+            prefilter.record_skip(chunk.tokens)
+        yield chunk
 
-    prompt = f"Messages:\n{indent(json_dump(messages_chunk, 2))}"
-    try:
-        response = ask_gpt(prompt)
-        log(log_file, f"response:\n{indent(yaml_dump([response]), 2)}")
-    except Exception:
-        log(log_file, "response: error")
+
+def is_prefiltered(chunk: Chunk):
+    return chunk.prefilter is not None and chunk.prefilter.benign
+
+
+def check_urls(chunks, reputation: UrlReputation):
+    """Starts the checks of the links of every chunk going to the model, they run while the chunks ahead are analyzed"""
+    for chunk in chunks:
+        if not is_prefiltered(chunk):
+            with metrics.timer("urls"):
+                urls = dict.fromkeys(url for item in chunk.items for url in extract_urls(item.message))
+                chunk.urls = {url: reputation.check(url) for url in urls}
+        yield chunk
+
+
+def encode_chunk(chunk: Chunk) -> tuple[str, dict[str, str]]:
+    prompt, aliases = encoder.encode(chunk.messages)
+    if chunk.urls:
+        # a verdict that is late doesn't hold the chunk back longer than urls.wait
+        with metrics.timer("urls_wait"):
+            verdicts = reputation.get_verdicts(chunk.urls, timeparse(config.urls.wait))
+        chunk.verdicts = list(verdicts.values())
+        section = format_verdicts(chunk.verdicts, config.urls.max_tokens)
+        prompt += section
+        # encoded again in a retry round, with the verdicts that came in meanwhile
+        urls_tokens = count_tokens(section)
+        chunk.tokens += urls_tokens - chunk.urls_tokens
+        chunk.urls_tokens = urls_tokens
+    return prompt, aliases
+
+
+def analyze_messages_chunk(chunk: Chunk):
+    if is_prefiltered(chunk):
+        return get_prefiltered_response(chunk.prefilter)
+    prompt, aliases = encode_chunk(chunk)
+    chunk.usage = {}
+    if args.cascade:
+        response = ask_cascade(prompt, chunk.usage)
+    else:
+        response = ask_gpt(prompt, chunk.usage)
+        metrics.add_usage(chunk.usage)
+    return encoder.decode_response(response, aliases)
+
+
+def get_batch_id(chunk: Chunk):
+    # stable across --resume, which restarts right after the last logged chunk
+    return f"chunk-{chunk.items[0].id}"
+
+
+def analyze_batch(chunks, batch_path: pathlib.Path, checkpoint: Checkpoint, checkpoint_path: pathlib.Path):
+    """Sends the chunks missing from the cache as one batch job and yields (chunk, response, error) once it is done"""
+    chunks = list(chunks)
+    prompts = {}
+    requests = []
+    for chunk in chunks:
+        if is_prefiltered(chunk):
+            continue
+        prompt, aliases = encode_chunk(chunk)
+        prompts[get_batch_id(chunk)] = (prompt, aliases)
+        if get_cached(prompt) is None:
+            requests.append(get_batch_request(get_batch_id(chunk), get_request(prompt)))
+
+    responses = {}
+    if requests:
+        client = llm.get_openai()
+        if checkpoint.batch_id is None:
+            write_batch_file(batch_path, requests)
+            checkpoint.batch_id = submit_batch(client, batch_path, config.batch.completion_window)
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"batch: {checkpoint.batch_id}, {len(requests)} requests from {batch_path}")
+        else:
+            print(f"batch: waiting for {checkpoint.batch_id}")
+        with metrics.timer("batch"):
+            batch = wait_batch(
+                client, checkpoint.batch_id, timeparse(config.batch.poll_interval), timeparse(config.batch.timeout)
+            )
+        print(f"batch: {batch.id} {batch.status}")
+        responses = get_batch_results(client, batch)
+
+    arguments = {}
+    usages = {}
+    for custom_id, body in responses.items():
+        if custom_id not in prompts or "error" in body:
+            continue
+        function_call = body["choices"][0]["message"].get("function_call")
+        if function_call and function_call["name"] == "analyzer":
+            arguments[custom_id] = json.loads(function_call["arguments"])
+            usage = body.get("usage") or {}
+            usages[custom_id] = dict(
+                model=body.get("model") or MODEL,
+                prompt_tokens=usage.get("prompt_tokens"),
+                completion_tokens=usage.get("completion_tokens"),
+                batch=True,
+            )
+            # cached before anything is logged, a crash from here on doesn't lose the batch
+            set_cached(prompts[custom_id][0], arguments[custom_id])
+
+    checkpoint.batch_id = None
+    for chunk in chunks:
+        if is_prefiltered(chunk):
+            yield chunk, get_prefiltered_response(chunk.prefilter), None
+            continue
+        custom_id = get_batch_id(chunk)
+        prompt, aliases = prompts[custom_id]
+        response = arguments.get(custom_id)
+        if response is not None:
+            chunk.usage = usages[custom_id]
+        else:
+            response = get_cached(prompt)
+            chunk.usage = dict(model=MODEL, cached=True)
+        metrics.add_usage(chunk.usage)
+        if response is None:
+            error = responses.get(custom_id, dict(error="missing from the batch output")).get("error")
+            yield chunk, None, RuntimeError(error or "no analyzer call in the response")
+        else:
+            yield chunk, encoder.decode_response(response, aliases), None
+
+
+def get_chunk_cost(chunk: Chunk):
+    # None skips the rate limiter, --cascade takes it for each tier it asks
+    if is_prefiltered(chunk) or args.cascade:
+        return None
+    # the verdicts are added after the limiter is asked, their whole share of the budget is taken
+    return chunk.tokens + config.llm.max_tokens + (config.urls.max_tokens - chunk.urls_tokens if chunk.urls else 0)
+
+
+def get_prompt_tokens(chunk: Chunk):
+    return {name: count_tokens(get_encoder(name).encode(chunk.messages)[0]) for name in ENCODERS}
+
+
+def process_messages_chunk(
+    now: datetime.datetime,
+    log_file: TextIO,
+    chunk: Chunk,
+    response: dict,
+    error: Exception,
+    prompt_tokens: dict[str, int],
+    echo: bool = True,
+):
+    if not echo and args.no_log:
+        return
+
+    def write(text: str):
+        log(log_file, text, echo)
+
+    write("---")
+    write("messages:")
+    write(f"  count: {len(chunk.messages)}")
+    write(f"  tokens: {chunk.tokens}")
+    write(f"  encoding: {encoder.name}")
+    write(f"  prompt_tokens:\n{indent(yaml_dump([prompt_tokens]), 4)}")
+    write(f"  from: {chunk.messages[0].date}")
+    write(f"  to: {chunk.messages[-1].date}")
+    if chunk.prefilter is not None:
+        write(f"prefilter:\n{indent(yaml_dump([chunk.prefilter]), 2)}")
+    if chunk.usage is not None and "tier" in chunk.usage:
+        write(f"cascade:\n  tier: {chunk.usage['tier']}\n  model: {chunk.usage['model']}")
+    if args.log_usage and chunk.usage is not None:
+        write(f"usage:\n{indent(yaml_dump([chunk.usage]), 2)}")
+
+    if chunk.verdicts:
+        write(f"urls:\n{indent(yaml_dump([{verdict.url: verdict.label for verdict in chunk.verdicts}]), 2)}")
+    if chunk.retries:
+        write(f"retries: {chunk.retries}")
+
+    if error is None:
+        write(f"response:\n{indent(yaml_dump([response]), 2)}")
+    else:
+        write("response: error")
+
+
+class ChatRun(object):
+    """Log, checkpoint and chunk stream of one export"""
+
+    def __init__(self, name: str, now: datetime.datetime, echo: bool = True, data_path: pathlib.Path | None = None):
+        self.data_path = data_path
+        self.name = name
+        self.now = now
+        self.echo = echo
+        self.log_dir = pathlib.Path(config.root_dir / f"tmp/logs/{self.name}/{args.agent}")
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.checkpoint_path = self.log_dir / "checkpoint.json"
+
+        checkpoint = load_checkpoint(self.checkpoint_path) if args.resume else None
+        if checkpoint is not None:
+            self.log_file_path = pathlib.Path(checkpoint.log_file)
+            self.log_file = self.log_file_path.open("a")
+            print(
+                f"resume {self.name}: {checkpoint.chunks} chunks done, "
+                f"last message {checkpoint.last_id} at {checkpoint.last_date}"
+            )
+        else:
+            self.log_file_path = self.log_dir / f"{now:%Y-%m-%d-%H-%M-%S}.yaml"
+            self.log_file = self.log_file_path.open("w")
+            checkpoint = Checkpoint(log_file=self.log_file_path.as_posix())
+        self.checkpoint = checkpoint
+
+        self.duplicates = None
+        if args.dedup:
+            self.duplicates = DuplicateIndex(threshold=config.dedup.threshold, min_length=config.dedup.min_length)
+        self.prefilter = None
+        if args.prefilter:
+            self.prefilter = Prefilter(
+                config.prefilter.threshold,
+                config.prefilter.weights.to_dict(),
+                config.prefilter.keywords,
+                config.prefilter.warmup,
+                config.prefilter.max_users,
+                config.prefilter.min_length,
+            )
+
+        self.prompt_tokens = dict.fromkeys(ENCODERS, 0)
+        # chunks that failed and wait for the next retry round
+        self.failed = []
+        self.chunks = 0
+        self.messages = 0
+        self.pending = 0
+        self.exhausted = False
+        self.closed = False
+
+    def get_chunks(self):
+        min_id = max((value for value in [args.min_id, self.checkpoint.last_id] if value is not None), default=None)
+        chunks = get_messages_chunk(self.data_path, min_id, args.since, args.until, self.duplicates)
+        chunks = itertools.chain(self.get_failed_chunks(), chunks)
+        if self.prefilter is not None:
+            chunks = prefilter_chunks(chunks, self.prefilter)
+        if reputation is not None:
+            chunks = check_urls(chunks, reputation)
+        return chunks
+
+    def get_failed_chunks(self):
+        # the chunks an earlier run gave up on come first on --resume
+        for first_id, last_id in list(self.checkpoint.failed):
+            builder = ChunkBuilder()
+            chunks = []
+            items = get_items(self.data_path, first_id - 1, workers=args.workers)
+            for item in filter_items(itertools.takewhile(lambda item: item.id <= last_id, items)):
+                chunks += builder.add(item)
+            if builder.items:
+                chunks.append(builder.pop())
+            for chunk in chunks:
+                # the run that logged it as an error counted it
+                chunk.counted = True
+                yield chunk
+
+    def record(self, chunk: Chunk, response: dict, error: Exception, final: bool = True):
+        """A failed chunk goes to the retry queue unless final, it is logged once it succeeds or runs out of rounds"""
+        first_id, last_id = chunk.items[0].id, chunk.items[-1].id
+        if error is None:
+            # a --resume retry may be split differently than the failed chunk it comes from
+            self.checkpoint.failed = [
+                span for span in self.checkpoint.failed if not (span[0] <= first_id and last_id <= span[1])
+            ]
+        elif [first_id, last_id] not in self.checkpoint.failed:
+            self.checkpoint.failed.append([first_id, last_id])
+        if error is not None and not final:
+            self.failed.append(chunk)
+            self.save_checkpoint(chunk)
+            return
+
+        # what the same chunk costs in every encoding, to compare them on real chats
+        with metrics.timer("encode"):
+            prompt_tokens = get_prompt_tokens(chunk)
+        for name, value in prompt_tokens.items():
+            self.prompt_tokens[name] += value
+        with metrics.timer("log"):
+            process_messages_chunk(self.now, self.log_file, chunk, response, error, prompt_tokens, self.echo)
+        if store is not None:
+            with metrics.timer("store"):
+                store.add(self.name, args.agent, self.now, chunk, response, error, encoder.name)
+
+        # the chunk is on disk before the checkpoint moves past it
+        self.log_file.flush()
+        if not chunk.counted:
+            self.checkpoint.chunks += 1
+            chunk.counted = True
+        self.save_checkpoint(chunk)
+        self.chunks += 1
+        self.messages += len(chunk.items)
+        metrics.add_chunk(len(chunk.items))
+
+    def save_checkpoint(self, chunk: Chunk):
+        with metrics.timer("checkpoint"):
+            # retried chunks come after the later ones, last_id never goes back
+            if self.checkpoint.last_id is None or chunk.items[-1].id > self.checkpoint.last_id:
+                self.checkpoint.last_id = chunk.items[-1].id
+                self.checkpoint.last_date = chunk.items[-1].date
+            save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.log_file.close()
+        print(f"{self.name}: {self.chunks} chunks, {self.messages} messages")
+        print("prompt_tokens: ", self.prompt_tokens)
+        if self.duplicates is not None:
+            print("dedup: ", self.duplicates.stats())
+        if self.prefilter is not None:
+            print("prefilter: ", self.prefilter.stats())
+        print("saved_to: ", self.log_file_path)
+
+
+def interleave(runs: list[ChatRun]):
+    """Round robin over the chats, one chunk at a time, so a long chat doesn't hold back the short ones"""
+    streams = [(run, run.get_chunks()) for run in runs]
+    while streams:
+        for stream in list(streams):
+            run, chunks = stream
+            chunk = next(chunks, None)
+            if chunk is None:
+                run.exhausted = True
+                streams.remove(stream)
+                continue
+            run.pending += 1
+            yield run, chunk
+
+
+class Progress(object):
+    """Aggregate throughput over all the chats of the run"""
+
+    def __init__(self, runs: list[ChatRun], interval: float):
+        self.runs = runs
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def update(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        chunks = sum(run.chunks for run in self.runs)
+        messages = sum(run.messages for run in self.runs)
+        done = sum(1 for run in self.runs if run.closed)
+        print(
+            f"progress: {done}/{len(self.runs)} chats, {chunks} chunks, {messages} messages in {elapsed:.0f}s, "
+            f"{messages / elapsed:.1f} messages/s, {chunks * 60 / elapsed:.1f} chunks/min"
+        )
 
 
 def process():
-    data_path = pathlib.Path(args.input)
+    data_paths = get_export_paths(args.input)
+    if not data_paths:
+        raise FileNotFoundError(f"no exports found in {args.input}")
+    now = datetime.datetime.now()
+    # with several chats stdout only shows the progress, the responses are in the per-chat logs
+    echo = len(data_paths) == 1
+    runs = [ChatRun(data_path.stem, now, echo, data_path) for data_path in data_paths]
+    progress = Progress(runs, timeparse(config.llm.progress_interval))
+
+    if args.batch:
+        # every chat is its own batch job, they are waited for one after another
+        for run in runs:
+            batch_path = run.log_file_path.with_suffix(".batch.jsonl")
+            for chunk, response, error in analyze_batch(
+                run.get_chunks(), batch_path, run.checkpoint, run.checkpoint_path
+            ):
+                run.record(chunk, response, error)
+            run.close()
+    else:
+
+        def analyze(item: tuple[ChatRun, Chunk]):
+            return analyze_messages_chunk(item[1])
+
+        def get_cost(item: tuple[ChatRun, Chunk]):
+            return get_chunk_cost(item[1])
+
+        def analyze_all(items):
+            # one pool for all the chats
+            return dispatch(
+                analyze,
+                items,
+                concurrency=concurrency,
+                limiter=limiter,
+                cost=get_cost,
+                retries=config.llm.retries,
+                backoff=timeparse(config.llm.backoff),
+                deadline=timeparse(config.llm.deadline),
+            )
+
+        rounds = config.llm.retry_rounds
+        for (run, chunk), response, error in analyze_all(interleave(runs)):
+            run.record(chunk, response, error, final=rounds == 0)
+            run.pending -= 1
+            if run.exhausted and run.pending == 0 and not run.failed:
+                run.close()
+            progress.update()
+
+        # a chunk that failed with every retry of the first pass gets another go once the rest is done
+        for retry in range(1, rounds + 1):
+            failed = [(run, chunk) for run in runs for chunk in run.failed]
+            if not failed:
+                break
+            print(f"retry {retry}/{rounds}: {len(failed)} chunks")
+            metrics.add_count("retried", len(failed))
+            for run in runs:
+                run.failed = []
+            for (run, chunk), response, error in analyze_all(failed):
+                chunk.retries = retry
+                run.record(chunk, response, error, final=retry == rounds)
+                progress.update()
+
+    for run in runs:
+        run.close()
+    if len(runs) > 1:
+        progress.update(force=True)
+    if cache is not None:
+        print("cache: ", cache.stats())
+        cache.close()
+    if store is not None:
+        print("results: ", store.path)
+        store.close()
+    close_clients()
+    save_metrics(now)
+
+
+def close_clients():
+    if hedge_executor is not None:
+        # the slower copies still running are paid for, their usage is in the metrics once they are done
+        hedge_executor.shutdown(wait=True)
+    llm.close()
+    if reputation is not None:
+        print("urls: ", reputation.stats())
+        reputation.close()
+
+
+class ChatMonitor(object):
+    """Windows the live messages of one chat and analyzes every chunk as soon as its window closes"""
+
+    def __init__(self, run: ChatRun, executor: ThreadPoolExecutor):
+        self.run = run
+        self.executor = executor
+        self.builder = ChunkBuilder(run.duplicates)
+        # the open window is bounded by count_max and the token budget, the backlog by max_pending
+        self.queue = asyncio.Queue(config.monitor.max_pending)
+
+    async def add(self, message: telethon.tl.custom.Message):
+        item = decode_item(json_dump(message.to_dict()))
+        if item is None:
+            return
+        if self.run.duplicates is not None and len(self.run.duplicates.groups) >= config.monitor.max_groups:
+            self.run.duplicates = self.builder.duplicates = DuplicateIndex(
+                threshold=config.dedup.threshold, min_length=config.dedup.min_length
+            )
+        for item in filter_items([item]):
+            for chunk in self.builder.add(item):
+                await self.put(chunk)
+
+    async def put(self, chunk: Chunk):
+        if self.run.prefilter is not None:
+            chunk = next(prefilter_chunks([chunk], self.run.prefilter))
+        if reputation is not None:
+            chunk = next(check_urls([chunk], reputation))
+        await self.queue.put(chunk)
+
+    async def expire(self, max_latency: float):
+        # a quiet chat never reaches count_min, close its window once the first message waited long enough
+        while True:
+            await asyncio.sleep(min(max_latency / 10, 5))
+            if self.builder.get_age(datetime.datetime.now(datetime.timezone.utc)) >= max_latency:
+                await self.put(self.builder.pop())
+
+    def analyze(self, chunk: Chunk) -> tuple[dict | None, Exception | None]:
+        try:
+            response = call_with_backoff(
+                analyze_messages_chunk,
+                chunk,
+                limiter,
+                get_chunk_cost(chunk),
+                config.llm.retries,
+                timeparse(config.llm.backoff),
+                timeparse(config.llm.deadline),
+            )
+            return response, None
+        except Exception as e:
+            return None, e
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await self.queue.get()
+            response, error = await loop.run_in_executor(self.executor, self.analyze, chunk)
+            # a live chat has no end of the run to wait for, the retry rounds of a chunk follow it right away
+            for retry in range(1, config.llm.retry_rounds + 1):
+                if error is None:
+                    break
+                await asyncio.sleep(timeparse(config.llm.backoff) * 2**retry)
+                chunk.retries = retry
+                metrics.add_count("retried")
+                response, error = await loop.run_in_executor(self.executor, self.analyze, chunk)
+            self.run.record(chunk, response, error)
+
+
+async def monitor():
     now = datetime.datetime.now()
-    name = data_path.stem
-    log_file_path = pathlib.Path(config.root_dir / f"tmp/logs/{name}/{args.agent}/{now:%Y-%m-%d-%H-%M-%S}.yaml")
-    log_file_path.parent.mkdir(parents=True, exist_ok=True)
-    log_file = log_file_path.open("w")
+    # one handler at a time, a full queue holds back the next update instead of piling up a task per message
+    client = telethon.TelegramClient(
+        config.root_dir / "session", int(get_pass("TG_API_ID")), get_pass("TG_API_HASH"), sequential_updates=True
+    )
+    # the chats share the workers and the rate limit like a multi-chat export run
+    executor = ThreadPoolExecutor(concurrency)
+    max_latency = timeparse(config.monitor.max_latency)
 
-    for messages_chunk in get_messages_chunk(data_path):
-        process_messages_chunk(now, log_file, messages_chunk)
-        # break
+    async with client:
+        monitors = {}
+        for name in args.monitor:
+            entity = await client.get_entity(name)
+            monitors[telethon.utils.get_peer_id(entity)] = ChatMonitor(ChatRun(name, now), executor)
+            print(f"monitor: {name}")
 
-    print("saved_to: ", log_file_path)
+        @client.on(telethon.events.NewMessage(chats=list(monitors)))
+        async def on_message(event: telethon.events.NewMessage.Event):
+            await monitors[event.chat_id].add(event.message)
+
+        tasks = [asyncio.create_task(chat.consume()) for chat in monitors.values()]
+        tasks += [asyncio.create_task(chat.expire(max_latency)) for chat in monitors.values()]
+        try:
+            await client.run_until_disconnected()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for chat in monitors.values():
+                chat.run.close()
+            if store is not None:
+                store.close()
+            close_clients()
+            save_metrics(now)
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 def research_01():
@@ -226,8 +1040,30 @@ def research_01():
         break
 
 
+def save_metrics(now: datetime.datetime):
+    summary = metrics.summary()
+    metrics_path = config.root_dir / f"tmp/metrics/{now:%Y-%m-%d-%H-%M-%S}.json"
+    metrics_path.parent.mkdir(parents=True, exist_ok=True)
+    metrics_path.write_text(json_dump(summary, 2))
+    print("metrics: ", json_dump(summary))
+    print("metrics_saved_to: ", metrics_path)
+
+
 def main():
-    process()
+    profiler = SamplingProfiler(config.profile.interval).start() if args.profile else None
+    try:
+        if args.monitor:
+            asyncio.run(monitor())
+        else:
+            process()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.print_top(config.profile.top)
+            profile_path = config.root_dir / f"tmp/metrics/{datetime.datetime.now():%Y-%m-%d-%H-%M-%S}.profile.txt"
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.write_collapsed(profile_path)
+            print("profile_saved_to: ", profile_path)
 
 
 if __name__ == "__main__":
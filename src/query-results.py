@@ -0,0 +1,33 @@
+import argparse
+import pathlib
+
+from module.config import get_config
+from module.results import ResultStore
+from module.utils import yaml_dump
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("--user", "-u")
+argparser.add_argument("--chat", "-c")
+argparser.add_argument("--suspicious", action="store_true")
+argparser.add_argument("--top", type=int)
+args = argparser.parse_args()
+
+root_dir = pathlib.Path(__file__).parents[1]
+config = get_config([root_dir / "config/global.yaml", root_dir / "local.yaml"], root_dir)
+
+
+def main():
+    store = ResultStore(config.root_dir / config.results.path)
+    if args.user is not None:
+        rows = store.get_user_chunks(args.user, args.chat)
+    elif args.suspicious:
+        rows = store.get_suspicious_chunks(args.chat)
+    else:
+        rows = store.get_top_users(args.chat, args.top or 20)
+    if rows:
+        print(yaml_dump(rows), end="")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# the scripts import their helpers as `module.*` from src/
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "src"))
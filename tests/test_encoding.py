@@ -0,0 +1,29 @@
+from module.encoding import TsvEncoder
+
+
+class Message(object):
+    def __init__(self, userID: str, text: str, date: str = "2024-01-01 00:00:00"):
+        self.userID = userID
+        self.text = text
+        self.date = date
+
+
+def test_message_text_keeps_alias_like_words():
+    encoder = TsvEncoder()
+    messages = [Message("1001", "join u1 and u23 now"), Message("1002", "hello")]
+    prompt, aliases = encoder.encode(messages)
+    assert aliases == {"u1": "1001", "u2": "1002"}
+
+    response = dict(
+        suspicious_users=["u1"],
+        potential_bots=["u2", "unknown"],
+        suspicious_messages=["join u1 and u23 now"],
+        advertising_activities=["u1: join u1 and u23 now"],
+        notes="u1 advertises",
+    )
+    decoded = encoder.decode_response(response, aliases)
+    assert decoded["suspicious_users"] == ["1001"]
+    assert decoded["potential_bots"] == ["1002", "unknown"]
+    assert decoded["suspicious_messages"] == ["join u1 and u23 now"]
+    assert decoded["advertising_activities"] == ["u1: join u1 and u23 now"]
+    assert response["suspicious_users"] == ["u1"]
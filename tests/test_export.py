@@ -0,0 +1,23 @@
+import json
+
+from module.export import get_items
+
+
+def test_workers_read_the_same_items(tmp_path):
+    path = tmp_path / "chat.jsonl"
+    lines = []
+    for id in range(40, 0, -1):
+        item = dict(id=id, date=f"2024-01-01T00:00:{id:02d}+00:00", message=f"message {id}")
+        if id % 3:
+            item["from_id"] = {"_": "PeerUser", "user_id": 1000 + id % 5}
+        else:
+            item["from_id"] = {"_": "PeerChannel", "channel_id": 7}
+            item["peer_id"] = {"_": "PeerChannel", "channel_id": 7}
+        lines.append(json.dumps(item))
+    lines.insert(5, json.dumps(dict(id=0, date="2024-01-01T00:00:00+00:00", action="join")))
+    path.write_text("\n".join(lines) + "\n")
+
+    items = list(get_items(path))
+    assert [item.id for item in items] == list(range(1, 41))
+    assert list(get_items(path, workers=2)) == items
+    assert list(get_items(path, min_id=20, workers=2)) == items[20:]
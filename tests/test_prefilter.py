@@ -0,0 +1,52 @@
+import datetime
+import pathlib
+
+from module.config import get_config
+from module.export import ExportItem, FromId
+from module.prefilter import Prefilter
+
+root_dir = pathlib.Path(__file__).parents[1]
+
+REPLIES = ["ок", "да", "+", "спасибо", "ага", "привет", "понял"]
+
+
+def get_prefilter() -> Prefilter:
+    config = get_config([root_dir / "config/global.yaml"], root_dir)
+    return Prefilter(
+        config.prefilter.threshold,
+        config.prefilter.weights.to_dict(),
+        config.prefilter.keywords,
+        config.prefilter.warmup,
+        config.prefilter.max_users,
+        config.prefilter.min_length,
+    )
+
+
+def get_chunk(start: int, texts: list[str], users: list[int]) -> list[ExportItem]:
+    date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        ExportItem(
+            id=start + index,
+            date=date + datetime.timedelta(seconds=start + index),
+            message=text,
+            from_id=FromId(from_type="PeerUser", user_id=str(users[index % len(users)])),
+        )
+        for index, text in enumerate(texts)
+    ]
+
+
+def test_ordinary_chunks_are_skipped():
+    prefilter = get_prefilter()
+    users = list(range(1, 21))
+    benign = []
+    for chunk in range(20):
+        texts = []
+        for index in range(60):
+            id = chunk * 60 + index
+            # a third of the messages are short replies repeated all over the chat
+            texts.append(REPLIES[id % len(REPLIES)] if index % 3 == 0 else f"вечером обсудим задачу номер {id}")
+        benign.append(prefilter.score(get_chunk(chunk * 60, texts, users)).benign)
+    assert benign[prefilter.warmup :] == [True] * (20 - prefilter.warmup)
+
+    spam = ["заходите в наш канал с лучшими предложениями дня"] * 10 + ["ок"] * 50
+    assert not prefilter.score(get_chunk(10000, spam, users)).benign
@@ -0,0 +1,36 @@
+import asyncio
+import datetime
+from concurrent.futures import Future
+
+import pytest
+
+from module.reputation import AsyncQuota, QuotaExceeded, UrlVerdict, is_reusable
+
+
+def test_daily_quota_starts_over_the_next_day():
+    async def run():
+        quota = AsyncQuota(daily=2)
+        await quota.acquire()
+        await quota.acquire()
+        assert quota.is_used_up()
+        with pytest.raises(QuotaExceeded):
+            await quota.acquire()
+
+        quota.day -= datetime.timedelta(days=1)
+        assert not quota.is_used_up()
+        await quota.acquire()
+        assert quota.used == 1
+
+    asyncio.run(run())
+
+
+def test_only_ok_verdicts_are_reused():
+    def done(status: str) -> Future:
+        future = Future()
+        future.set_result(UrlVerdict(url="http://example.com/", status=status))
+        return future
+
+    assert is_reusable(Future())
+    assert is_reusable(done("ok"))
+    for status in ["quota", "timeout", "error"]:
+        assert not is_reusable(done(status))
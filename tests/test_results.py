@@ -0,0 +1,46 @@
+import datetime
+from types import SimpleNamespace
+
+from module.results import ResultStore
+
+
+def get_chunk(first_id: int, last_id: int):
+    date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    items = [SimpleNamespace(id=first_id, date=date), SimpleNamespace(id=last_id, date=date)]
+    return SimpleNamespace(items=items, tokens=100, prefilter=None)
+
+
+def get_response(users: list[str]):
+    return dict(
+        suspicious_activity_detected=True,
+        suspicious_users=users,
+        suspicious_messages=["buy now"],
+        conversation_health="Suspicious",
+    )
+
+
+def test_same_chunk_replaces_its_row(tmp_path):
+    store = ResultStore(tmp_path / "results.sqlite")
+    run = datetime.datetime(2024, 1, 2)
+    chunk = get_chunk(1, 50)
+    first = store.add("chat", "agent", run, chunk, get_response(["1", "2"]), None)
+    second = store.add("chat", "agent", run + datetime.timedelta(hours=1), chunk, get_response(["1"]), None)
+
+    assert first == second
+    assert len(store.get_suspicious_chunks("chat")) == 1
+    assert store.get_top_users("chat") == [dict(user="1", chunks=1)]
+    assert store.get_user_chunks("2") == []
+    store.close()
+
+
+def test_other_chunks_and_agents_are_kept(tmp_path):
+    store = ResultStore(tmp_path / "results.sqlite")
+    run = datetime.datetime(2024, 1, 2)
+    store.add("chat", "agent", run, get_chunk(1, 50), get_response(["1"]), None)
+    store.add("chat", "agent", run, get_chunk(51, 100), get_response(["1"]), None)
+    store.add("chat", None, run, get_chunk(1, 50), get_response(["1"]), None)
+    store.add("chat", None, run, get_chunk(1, 50), get_response(["1"]), None)
+
+    assert len(store.get_suspicious_chunks()) == 3
+    assert store.get_top_users() == [dict(user="1", chunks=3)]
+    store.close()